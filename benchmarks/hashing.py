@@ -0,0 +1,79 @@
+"""
+Compare the throughput of brain4k's file hashing against the original
+128 byte read loop.
+
+usage: python benchmarks/hashing.py [file size in MB] [number of files]
+"""
+import os
+import sys
+import time
+import shutil
+import hashlib
+import tempfile
+from functools import partial
+
+from brain4k.data_interfaces import compute_file_hash, compute_file_hashes
+
+
+def legacy_compute_file_hash(file_path):
+    with open(file_path, mode='rb') as f:
+        d = hashlib.sha1()
+        for buf in iter(partial(f.read, 128), b''):
+            d.update(buf)
+
+    return d.hexdigest()
+
+
+def timed(label, total_bytes, func, *args):
+    start = time.time()
+    result = func(*args)
+    elapsed = time.time() - start
+    print "{0:<32} {1:>8.2f}s {2:>10.1f} MB/s".format(
+        label,
+        elapsed,
+        total_bytes / elapsed / (1 << 20)
+    )
+    return result
+
+
+def main():
+    file_size = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    file_count = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        file_paths = []
+        for index in xrange(file_count):
+            file_path = os.path.join(tmpdir, 'blob_{0}'.format(index))
+            with open(file_path, 'wb') as f:
+                for block in xrange(file_size):
+                    f.write(os.urandom(1 << 20))
+            file_paths.append(file_path)
+        total_bytes = file_size * file_count * (1 << 20)
+
+        print "hashing {0} files of {1} MB".format(file_count, file_size)
+        legacy = timed(
+            "legacy (128 byte reads)",
+            total_bytes,
+            lambda: [legacy_compute_file_hash(p) for p in file_paths]
+        )
+        sequential = timed(
+            "compute_file_hash",
+            total_bytes,
+            lambda: [compute_file_hash(p) for p in file_paths]
+        )
+        parallel = timed(
+            "compute_file_hashes",
+            total_bytes,
+            compute_file_hashes,
+            file_paths
+        )
+
+        if not legacy == sequential == [parallel[p] for p in file_paths]:
+            raise Exception("hash implementations disagree")
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
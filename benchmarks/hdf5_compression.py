@@ -0,0 +1,97 @@
+"""
+Compare write and read throughput and file size of the HDF5 storage options
+on data shaped like features extracted from a convolutional network.
+
+usage: python benchmarks/hdf5_compression.py [rows] [features]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+from brain4k.data_interfaces import HDF5Interface
+
+
+CODECS = [
+    ('none', {'compression': 'none'}),
+    ('lzf', {'compression': 'lzf'}),
+    ('lzf+shuffle', {'compression': 'lzf', 'shuffle': True}),
+    ('gzip 1', {'compression': 'gzip', 'compression_opts': 1}),
+    ('gzip 1+shuffle', {'compression': 'gzip', 'compression_opts': 1, 'shuffle': True}),
+    ('gzip 4', {'compression': 'gzip', 'compression_opts': 4}),
+    ('gzip 7 (default)', {}),
+    ('gzip 9', {'compression': 'gzip', 'compression_opts': 9}),
+]
+
+
+def feature_data(rows, features):
+    """
+    Activations after a ReLU: non-negative, with roughly half of them zero
+    """
+    rng = np.random.RandomState(0)
+    data = rng.standard_normal((rows, features)).astype(np.float32)
+    return np.maximum(data, 0) * 4
+
+
+def benchmark(tmpdir, label, options, data, chunk_rows):
+    io = HDF5Interface(os.path.join(tmpdir, 'features.h5'))
+    io.options = dict(options, chunk_rows=chunk_rows)
+    output_keys = {'features': {'dtype': 'float32', 'shape': list(data.shape)}}
+    megabytes = data.nbytes / float(1 << 20)
+
+    start = time.time()
+    h5py_file = io.open(mode='w')
+    io.create_dataset(h5py_file, output_keys)
+    io.write_chunk(h5py_file, {'features': data}, output_keys)
+    io.save(h5py_file)
+    write_time = time.time() - start
+
+    start = time.time()
+    h5py_file = io.open()
+    dataset = h5py_file['features']
+    for row in xrange(0, data.shape[0], chunk_rows):
+        dataset[row:row + chunk_rows]
+    io.close(h5py_file)
+    read_time = time.time() - start
+
+    size = os.path.getsize(io.filename) / float(1 << 20)
+    os.remove(io.filename)
+
+    print "{0:<20} {1:>10.1f} {2:>10.1f} {3:>10.1f} {4:>8.2f}".format(
+        label,
+        megabytes / write_time,
+        megabytes / read_time,
+        size,
+        megabytes / size
+    )
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    features = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    chunk_rows = 64
+
+    data = feature_data(rows, features)
+    print "{0} rows of {1} float32 features ({2:.1f}MB), {3} row chunks".format(
+        rows,
+        features,
+        data.nbytes / float(1 << 20),
+        chunk_rows
+    )
+    print "{0:<20} {1:>10} {2:>10} {3:>10} {4:>8}".format(
+        'codec', 'write MB/s', 'read MB/s', 'size MB', 'ratio'
+    )
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for label, options in CODECS:
+            benchmark(tmpdir, label, options, data, chunk_rows)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+import os
+import logging
+import tempfile
+
+from build_cache import link_or_copy
+
+
+DEFAULT_MAX_SIZE_MB = 20480
+STORE_ENV = 'BRAIN4K_BLOB_STORE'
+MAX_SIZE_ENV = 'BRAIN4K_BLOB_STORE_SIZE_MB'
+
+
+class BlobStore(object):
+    """
+    Machine-wide store of remote blobs keyed by their sha1, shared by every
+    brain4k repository on the machine, so a blob declared with the same
+    sha1 in several repos is only downloaded once.
+
+    Blobs are linked into repos by hardlink, reflink or copy.  Entries are
+    evicted least recently used first once the store grows beyond max_size
+    bytes; since they are hardlinks, the copies in repos are kept.  When a
+    blob was last used is recorded on a marker file beside it, as touching
+    the blob itself would change the mtime of every repo's copy.
+    """
+
+    USED_SUFFIX = '.used'
+
+    def __init__(self, store_dir, max_size=None):
+        self.store_dir = store_dir
+        if max_size is None:
+            max_size = DEFAULT_MAX_SIZE_MB << 20
+        self.max_size = max_size
+
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+
+    @classmethod
+    def from_environment(cls):
+        """
+        The store configured by BRAIN4K_BLOB_STORE, or None if it is unset
+        """
+        store_dir = os.environ.get(STORE_ENV, None)
+        if not store_dir:
+            return None
+
+        return cls(
+            os.path.expanduser(store_dir),
+            int(os.environ.get(MAX_SIZE_ENV, DEFAULT_MAX_SIZE_MB)) << 20
+        )
+
+    def _path(self, sha1):
+        return os.path.join(self.store_dir, sha1[:2], sha1)
+
+    def restore(self, sha1, filename):
+        """
+        Link the blob with sha1 to filename, returning False if it is not in
+        the store
+        """
+        path = self._path(sha1)
+        if not os.path.exists(path):
+            return False
+
+        link_or_copy(path, filename)
+        self._touch(path)
+        logging.info("Linked {0} from the blob store".format(filename))
+        return True
+
+    def add(self, sha1, filename):
+        """
+        Store the verified blob at filename under sha1, then trim the store
+        """
+        path = self._path(sha1)
+        if os.path.exists(path):
+            self._touch(path)
+            return
+
+        entry_dir = os.path.dirname(path)
+        if not os.path.exists(entry_dir):
+            try:
+                os.makedirs(entry_dir)
+            except OSError:
+                # another process sharing the store made it first
+                if not os.path.isdir(entry_dir):
+                    raise
+
+        # link alongside and rename into place, so other processes never
+        # see a partially copied blob
+        fd, tmp_path = tempfile.mkstemp(prefix='tmp-', dir=entry_dir)
+        os.close(fd)
+        os.remove(tmp_path)
+        try:
+            link_or_copy(filename, tmp_path)
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._touch(path)
+
+        self.gc()
+
+    def gc(self, max_size=None):
+        """
+        Remove least recently used blobs until the store is no larger than
+        max_size bytes, defaulting to the store's size cap.  Returns the
+        number of blobs removed and the bytes they held.
+        """
+        if max_size is None:
+            max_size = self.max_size
+
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.store_dir):
+            for name in filenames:
+                if name.endswith(self.USED_SUFFIX) or name.startswith('tmp-'):
+                    continue
+                path = os.path.join(dirpath, name)
+                used_path = path + self.USED_SUFFIX
+                try:
+                    size = os.path.getsize(path)
+                    if os.path.exists(used_path):
+                        last_used = os.path.getmtime(used_path)
+                    else:
+                        last_used = os.path.getmtime(path)
+                except OSError:
+                    # removed by another process as we walked the store
+                    continue
+                entries.append((last_used, size, path))
+
+        total_size = sum(size for last_used, size, path in entries)
+        removed = 0
+        freed = 0
+        for last_used, size, path in sorted(entries):
+            if total_size <= max_size:
+                break
+            for stale_path in (path, path + self.USED_SUFFIX):
+                if os.path.exists(stale_path):
+                    os.remove(stale_path)
+            total_size -= size
+            removed += 1
+            freed += size
+
+        if removed:
+            logging.info(
+                "Evicted {0} blobs from the blob store, freeing {1:.1f}MB"
+                .format(removed, freed / float(1 << 20))
+            )
+
+        return removed, freed
+
+    def _touch(self, path):
+        with open(path + self.USED_SUFFIX, 'a'):
+            os.utime(path + self.USED_SUFFIX, None)
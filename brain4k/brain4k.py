@@ -1,8 +1,12 @@
 import os
+import sys
 import logging
 from argparse import ArgumentParser
 
-from pipeline import execute_pipeline
+from pipeline import execute_pipeline, collect_garbage
+from server import serve
+from blob_store import BlobStore
+import tracing
 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -24,6 +28,46 @@ class Brain4kArgumentParser(ArgumentParser):
             action='store_true',
             help='Re-render the metrics and README.md'
         )
+        self.add_argument(
+            '--verify-hashes',
+            dest='verify_hashes',
+            action='store_true',
+            help='Ignore the file hash cache and re-hash every blob'
+        )
+        self.add_argument(
+            '--no-build-cache',
+            dest='use_build_cache',
+            action='store_false',
+            help='Do not restore or store stage outputs in the build cache'
+        )
+        self.add_argument(
+            '--resume',
+            dest='resume',
+            action='store_true',
+            help='Carry on from the rows a failed stage had written'
+        )
+        self.add_argument(
+            '--trace',
+            dest='trace_file',
+            action='store',
+            default=None,
+            help='write a Chrome trace of the run to this file, for chrome://tracing'
+        )
+        self.add_argument(
+            '--explain',
+            dest='explain',
+            action='store_true',
+            help='Show why each stage is skipped or run'
+        )
+        self.add_argument(
+            '-j',
+            '--jobs',
+            dest='jobs',
+            action='store',
+            type=int,
+            default=1,
+            help='number of independent stages to run at once (default: 1)'
+        )
         self.add_argument(
             '-p',
             dest='pipeline_name',
@@ -34,17 +78,151 @@ class Brain4kArgumentParser(ArgumentParser):
         )
 
 
-def run():
-    parser = Brain4kArgumentParser()
-    brain4k_args = parser.parse_args()
+class Brain4kServeArgumentParser(ArgumentParser):
 
+    def __init__(self, *args, **kwargs):
+        super(Brain4kServeArgumentParser, self).__init__(*args, **kwargs)
+        self.add_argument(
+            'repo path',
+            nargs='?',
+            default=os.getcwd(),
+            help='Path to the brain4k repository'
+        )
+        self.add_argument(
+            '-p',
+            dest='pipeline_name',
+            action='store',
+            default='predict',
+            help='specify the ephemeral pipeline to serve (default: predict)'
+        )
+        self.add_argument(
+            '--host',
+            dest='host',
+            action='store',
+            default='127.0.0.1',
+            help='interface to listen on (default: 127.0.0.1)'
+        )
+        self.add_argument(
+            '--port',
+            dest='port',
+            action='store',
+            type=int,
+            default=8000,
+            help='port to listen on (default: 8000)'
+        )
+        self.add_argument(
+            '--max-batch-size',
+            dest='max_batch_size',
+            action='store',
+            type=int,
+            default=32,
+            help='most urls to batch into one pass through the pipeline (default: 32)'
+        )
+        self.add_argument(
+            '--max-wait-ms',
+            dest='max_wait_ms',
+            action='store',
+            type=float,
+            default=20,
+            help='how long to wait for more requests to batch together (default: 20)'
+        )
+
+
+class Brain4kCacheArgumentParser(ArgumentParser):
+
+    def __init__(self, *args, **kwargs):
+        super(Brain4kCacheArgumentParser, self).__init__(*args, **kwargs)
+        self.add_argument(
+            'command',
+            choices=['gc'],
+            help='gc: evict least recently used build cache entries, and blobs '
+                 'from the blob store if BRAIN4K_BLOB_STORE is set'
+        )
+        self.add_argument(
+            'repo path',
+            nargs='?',
+            default=os.getcwd(),
+            help='Path to the brain4k repository'
+        )
+        self.add_argument(
+            '--max-size-mb',
+            dest='max_size_mb',
+            action='store',
+            type=int,
+            default=None,
+            help='size to trim the build cache to (default: build_cache_size_mb in pipeline.json)'
+        )
+
+
+def absolute_repo_path(brain4k_args):
     repo_path = getattr(brain4k_args, 'repo path')
     if not os.path.isabs(repo_path):
         repo_path = os.path.join(os.getcwd(), repo_path)
 
-    execute_pipeline(
-        repo_path,
-        brain4k_args.pipeline_name[0],
-        pipeline_args=brain4k_args.pipeline_name[1:],
-        force_render_metrics=brain4k_args.force_render_metrics
+    return repo_path
+
+
+def run():
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        return run_server(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'cache':
+        return run_cache(sys.argv[2:])
+
+    parser = Brain4kArgumentParser()
+    brain4k_args = parser.parse_args()
+
+    if brain4k_args.trace_file:
+        tracing.enable()
+    try:
+        execute_pipeline(
+            absolute_repo_path(brain4k_args),
+            brain4k_args.pipeline_name[0],
+            pipeline_args=brain4k_args.pipeline_name[1:],
+            force_render_metrics=brain4k_args.force_render_metrics,
+            verify_hashes=brain4k_args.verify_hashes,
+            jobs=brain4k_args.jobs,
+            explain=brain4k_args.explain,
+            use_build_cache=brain4k_args.use_build_cache,
+            resume=brain4k_args.resume
+        )
+    finally:
+        if brain4k_args.trace_file:
+            tracing.save(brain4k_args.trace_file)
+            logging.info("Wrote trace to {0}".format(brain4k_args.trace_file))
+
+
+def run_server(args):
+    parser = Brain4kServeArgumentParser(prog='brain4k serve')
+    brain4k_args = parser.parse_args(args)
+
+    serve(
+        absolute_repo_path(brain4k_args),
+        brain4k_args.pipeline_name,
+        host=brain4k_args.host,
+        port=brain4k_args.port,
+        max_batch_size=brain4k_args.max_batch_size,
+        max_wait=brain4k_args.max_wait_ms / 1000.0
     )
+
+
+def run_cache(args):
+    parser = Brain4kCacheArgumentParser(prog='brain4k cache')
+    brain4k_args = parser.parse_args(args)
+
+    max_size = brain4k_args.max_size_mb
+    if max_size is not None:
+        max_size = max_size << 20
+
+    removed, freed = collect_garbage(absolute_repo_path(brain4k_args), max_size)
+    print "Removed {0} build cache entries ({1:.1f}MB)".format(
+        removed,
+        freed / float(1 << 20)
+    )
+
+    blob_store = BlobStore.from_environment()
+    if blob_store:
+        removed, freed = blob_store.gc()
+        print "Removed {0} blobs from the blob store ({1:.1f}MB)".format(
+            removed,
+            freed / float(1 << 20)
+        )
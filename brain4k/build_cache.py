@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import shutil
+import logging
+import tempfile
+import subprocess
+
+
+DEFAULT_MAX_SIZE_MB = 10240
+
+
+class BuildCache(object):
+    """
+    Content-addressed store of stage outputs, kept under cache/build.
+
+    Each entry is keyed by a stage's build key (see
+    PipelineStage.compute_build_key), so when a stage is run again with
+    inputs, files, transform and parameters it has been run with before, its
+    outputs are restored by hardlink, or copy, instead of being recomputed.
+    Entries are evicted least recently used first once the store grows
+    beyond max_size bytes.
+    """
+
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        if max_size is None:
+            max_size = DEFAULT_MAX_SIZE_MB << 20
+        self.max_size = max_size
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    @classmethod
+    def for_repo(cls, repo_path, config):
+        return cls(
+            os.path.join(repo_path, 'cache', 'build'),
+            config.get('build_cache_size_mb', DEFAULT_MAX_SIZE_MB) << 20
+        )
+
+    def restore(self, key, outputs):
+        """
+        Link the stored outputs for key into place, returning False if there
+        is no complete entry for it
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        manifest = self._read_manifest(entry_dir)
+        if manifest is None:
+            return False
+
+        stored_outputs = manifest['outputs']
+        if set(datum.name for datum in outputs) != set(stored_outputs):
+            return False
+
+        for datum in outputs:
+            stored_path = os.path.join(entry_dir, stored_outputs[datum.name])
+            if not os.path.exists(stored_path):
+                return False
+
+        for datum in outputs:
+            if os.path.exists(datum.filename):
+                os.remove(datum.filename)
+            link_or_copy(
+                os.path.join(entry_dir, stored_outputs[datum.name]),
+                datum.filename
+            )
+
+        self._touch(entry_dir)
+        return True
+
+    def store(self, key, outputs):
+        entry_dir = os.path.join(self.cache_dir, key)
+        if os.path.exists(entry_dir):
+            self._touch(entry_dir)
+            return
+
+        # build the entry alongside and rename it into place, so a partially
+        # written entry is never visible
+        tmp_dir = tempfile.mkdtemp(prefix='tmp-', dir=self.cache_dir)
+        try:
+            stored_outputs = {}
+            size = 0
+            for datum in outputs:
+                link_or_copy(datum.filename, os.path.join(tmp_dir, datum.name))
+                stored_outputs[datum.name] = datum.name
+                size += os.path.getsize(datum.filename)
+
+            with open(os.path.join(tmp_dir, self.MANIFEST), 'w') as f:
+                f.write(json.dumps({'outputs': stored_outputs, 'size': size}))
+
+            os.rename(tmp_dir, entry_dir)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+    def gc(self, max_size=None):
+        """
+        Remove least recently used entries until the store is no larger than
+        max_size bytes, defaulting to the cache's size cap.  Returns the
+        number of entries removed and the bytes they held.
+        """
+        if max_size is None:
+            max_size = self.max_size
+
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if name.startswith('tmp-'):
+                # left behind by an interrupted store
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            manifest = self._read_manifest(entry_dir)
+            if manifest is None:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            last_used = os.path.getmtime(os.path.join(entry_dir, self.MANIFEST))
+            entries.append((last_used, manifest['size'], entry_dir))
+
+        total_size = sum(size for last_used, size, entry_dir in entries)
+        removed = 0
+        freed = 0
+        for last_used, size, entry_dir in sorted(entries):
+            if total_size <= max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+            removed += 1
+            freed += size
+
+        if removed:
+            logging.info(
+                "Evicted {0} build cache entries, freeing {1:.1f}MB"
+                .format(removed, freed / float(1 << 20))
+            )
+
+        return removed, freed
+
+    def _read_manifest(self, entry_dir):
+        try:
+            with open(os.path.join(entry_dir, self.MANIFEST), 'r') as f:
+                return json.loads(f.read())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _touch(self, entry_dir):
+        os.utime(os.path.join(entry_dir, self.MANIFEST), None)
+
+
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        if not reflink(source, destination):
+            shutil.copy2(source, destination)
+
+
+def reflink(source, destination):
+    """
+    Clone source to destination sharing its blocks copy-on-write, where the
+    filesystem supports it, as between devices hardlinks cannot be used
+    """
+    if not sys.platform.startswith('linux'):
+        return False
+
+    with open(os.devnull, 'w') as devnull:
+        returncode = subprocess.call(
+            ['cp', '--reflink=always', source, destination],
+            stderr=devnull
+        )
+
+    return returncode == 0
+
+
+def unlink_shared_outputs(outputs):
+    """
+    Remove any outputs that are hardlinked into the build cache, so a stage
+    writing them in place does not alter the cached copy
+    """
+    for datum in outputs:
+        if datum.data_type == 'argument' or not os.path.exists(datum.filename):
+            continue
+        if os.stat(datum.filename).st_nlink > 1:
+            os.remove(datum.filename)
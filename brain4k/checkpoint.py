@@ -0,0 +1,134 @@
+import os
+import json
+import logging
+
+
+class CheckpointJournal(object):
+    """
+    Append-only record of the row ranges of an output file that have been
+    written and flushed, so a stage that fails part way through can resume
+    from the first unfinished range instead of starting over.
+
+    The first line of the journal holds a key identifying the stage run that
+    wrote it, along with the input rows the output covers if it only covers
+    some, as a shard does, and each following line a committed
+    [start, stop, keys] range.  A journal is only resumed from when its key
+    and input rows match and its output file still exists.
+    """
+
+    def __init__(self, filename, output_filename, key, resume=False, input_rows=None):
+        self.filename = filename
+        self.output_filename = output_filename
+        self.key = key
+        self.input_rows = list(input_rows) if input_rows is not None else None
+        self.ranges = []
+
+        if resume:
+            self._load()
+        # whether rows written by an earlier run are being carried on from
+        self.resumed = bool(self.ranges)
+        if not self.resumed:
+            self.reset()
+
+    @classmethod
+    def for_output(cls, output_filename, key, resume=False, input_rows=None):
+        return cls(output_filename + '.journal', output_filename, key, resume, input_rows)
+
+    @property
+    def has_commits(self):
+        return bool(self.ranges)
+
+    def _load(self):
+        if not os.path.exists(self.filename) or not os.path.exists(self.output_filename):
+            return
+
+        with open(self.filename, 'r') as f:
+            lines = f.read().splitlines()
+
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, ValueError):
+            return
+        if header.get('key', None) != self.key:
+            logging.info(
+                "Not resuming {0}, the stage has changed since it was written"
+                .format(self.output_filename)
+            )
+            return
+        if header.get('input_rows', None) != self.input_rows:
+            logging.info(
+                "Not resuming {0}, it covers input rows {1} rather than {2}"
+                .format(self.output_filename, header.get('input_rows', None), self.input_rows)
+            )
+            return
+
+        for line in lines[1:]:
+            try:
+                start, stop, keys = json.loads(line)
+            except ValueError:
+                # the last line may have been cut short by the crash
+                break
+            self.ranges.append((start, stop, set(keys)))
+
+        if self.ranges:
+            logging.info(
+                "Resuming {0} with {1} committed row ranges"
+                .format(self.output_filename, len(self.ranges))
+            )
+
+    def reset(self):
+        self.ranges = []
+        self.resumed = False
+        header = {'key': self.key}
+        if self.input_rows is not None:
+            header['input_rows'] = self.input_rows
+        with open(self.filename, 'w') as f:
+            f.write(json.dumps(header) + '\n')
+
+    def commit(self, start, stop, keys):
+        """
+        Record rows start to stop of keys as written.  The output must have
+        been flushed first.
+        """
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps([start, stop, sorted(keys)]) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.ranges.append((start, stop, set(keys)))
+
+    def is_committed(self, start, stop, keys):
+        """
+        Whether rows start to stop of every one of keys have been committed
+        """
+        for key in keys:
+            covered = sorted(
+                (range_start, range_stop) for range_start, range_stop, range_keys in self.ranges
+                if key in range_keys and range_stop > start and range_start < stop
+            )
+            position = start
+            for range_start, range_stop in covered:
+                if range_start > position:
+                    break
+                position = max(position, range_stop)
+            if position < stop:
+                return False
+
+        return True
+
+    def committed_stop(self, keys):
+        """
+        The end of the rows of keys committed without gaps from the first
+        """
+        stop = 0
+        while True:
+            covering = [
+                range_stop for range_start, range_stop, range_keys in self.ranges
+                if range_start <= stop < range_stop and set(keys) <= range_keys
+            ]
+            if not covering:
+                return stop
+            stop = max(covering)
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
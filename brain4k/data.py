@@ -1,16 +1,15 @@
 import os
 import errno
-import sys
-import urllib
 
 from data_interfaces import (
     CSVInterface,
     HDF5Interface,
     PickleInterface,
     FileInterface,
-    MarkdownInterface,
-    compute_file_hash
+    MarkdownInterface
 )
+from fetch import download_file
+from blob_store import BlobStore
 
 
 def path_to_file(repo_path, *args):
@@ -30,61 +29,97 @@ def mkdir_p(path):
 
 
 class Data(object):
+    """
+    A blob of data named in pipeline.json.
+
+    Nothing is touched on disk until it is needed: the filename is resolved
+    on first access, and the directory is only created, and a remote blob
+    only downloaded, once prepare is called before the blob is used.
+    """
 
     def __init__(self, name, config, data_config, *args, **kwargs):
         self.name = name
         self.data_type = data_config.get('data_type', '')
 
         self.filehash = data_config.get('sha1', None)
-        local_filename = data_config.get('local_filename', None)
-        url = data_config.get('url', None)
+        self.local_filename = data_config.get('local_filename', None)
+        self.url = data_config.get('url', None)
+        self.repo_path = config.get('repo_path', None)
+        self._filename = None
+        self._io = None
 
         if self.data_type != 'argument':
-            if not local_filename and not url:
+            if not self.local_filename and not self.url:
                 raise ValueError(
                     "Each Data blob must have a local_filename or a url and sha1"
                     " hash specified."
                 )
-
-            self._set_filename(local_filename, url, config['repo_path'])
             self.io_class = FILE_INTERFACES.get(self.data_type, FileInterface)
-            self.io = self.io_class(self.filename)
 
-    def _set_filename(self, local_filename, url, repo_path):
+    @property
+    def filename(self):
+        if self.data_type == 'argument':
+            raise AttributeError("{0} is an argument, not a file".format(self.name))
+        if self._filename is None:
+            self._filename = self._resolve_filename()
+        return self._filename
+
+    @property
+    def io(self):
+        if self.data_type == 'argument':
+            raise AttributeError("{0} is an argument, not a file".format(self.name))
+        if self._io is None:
+            self._io = self.io_class(self.filename)
+            if self.data_type == 'csv' and self.repo_path:
+                self._io.index_dir = path_to_file(self.repo_path, 'cache', 'row_index')
+        return self._io
+
+    def _resolve_filename(self):
+        """
+        The first of the data type's folders holding the file, or the last
+        folder if none do
+        """
         folders = FILE_PATHS.get(self.data_type, ['data', 'cache'])
 
-        if local_filename:
-            base_name = os.path.basename(local_filename)
+        if self.local_filename:
+            base_name = os.path.basename(self.local_filename)
         else:
-            base_name = os.path.basename(url)
+            base_name = os.path.basename(self.url)
 
         for folder in folders:
-            self.filename = path_to_file(
-                repo_path,
+            filename = path_to_file(
+                self.repo_path,
                 folder,
                 base_name
             )
+            if os.path.exists(filename):
+                break
 
-            # make sure the directory exists
-            dirname = os.path.dirname(self.filename)
-            mkdir_p(dirname)
+        return filename
 
-            if os.path.exists(self.filename):
-                break
+    def prepare(self, timeout=60):
+        """
+        Make sure the blob's directory exists, and download it if it is a
+        remote file that has not been fetched yet, or link it from the
+        blob store if one is configured and holds it
+        """
+        if self.data_type == 'argument':
+            return
+
+        mkdir_p(os.path.dirname(self.filename))
 
-        if url and not os.path.exists(self.filename):
+        if self.url and not os.path.exists(self.filename):
             if not self.filehash:
                 raise ValueError(
                     "A sha1 hash must be specified for the remote file {0}"\
-                    .format(url)
-                )
-            download_with_progress_bar(url, self.filename)
-            filehash = compute_file_hash(self.filename)
-            if filehash != self.filehash:
-                raise Exception(
-                    "SHA1 hash of {0} does not match the one "
-                    "specified in pipeline.json".format(self.filename)
+                    .format(self.url)
                 )
+            blob_store = BlobStore.from_environment()
+            if blob_store and blob_store.restore(self.filehash, self.filename):
+                return
+            download_file(self.url, self.filename, self.filehash, timeout)
+            if blob_store:
+                blob_store.add(self.filehash, self.filename)
 
 
 FILE_INTERFACES = {
@@ -98,13 +133,3 @@ FILE_PATHS = {
     'figure': [os.path.join('metrics', 'figures')],
     'markdown': ['metrics'],
 }
-
-
-def download_with_progress_bar(url, local_file):
-    def dlProgress(count, block_size, total_size, url=url):
-        percent = int(count * block_size * 100 / total_size)
-        sys.stdout.write("\rDownloading " + url + "...%d%%" % percent)
-        sys.stdout.flush()
-
-    urllib.urlretrieve(url, local_file, reporthook=dlProgress)
-    sys.stdout.write("\n")
\ No newline at end of file
@@ -1,31 +1,64 @@
 import os
+import bz2
+import gzip
 import hashlib
 import json
 import logging
 import cPickle
 from functools import partial
+from cStringIO import StringIO
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 import h5py
 import numpy as np
-import pandas as pd
 
 from settings import template_env
+from tracing import span, traced
+
+
+# read files in large blocks, hashlib releases the GIL while digesting them
+HASH_BUFFER_SIZE = 1 << 20
 
 
 def compute_file_hash(file_path):
     logging.debug("computing hash for {0}".format(file_path))
+    d = hashlib.sha1()
+    buf = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buf)
     with open(file_path, mode='rb') as f:
-        d = hashlib.sha1()
-        for buf in iter(partial(f.read, 128), b''):
-            d.update(buf)
+        for size in iter(partial(f.readinto, buf), 0):
+            d.update(view[:size])
 
-        filehash = d.hexdigest()
+    filehash = d.hexdigest()
 
     return filehash
 
 
+def compute_file_hashes(file_paths, workers=None):
+    """
+    Hash several files at once on a thread pool.
+    Returns a dict mapping each path to its sha1 hash.
+    """
+    file_paths = list(file_paths)
+    if workers is None:
+        workers = min(len(file_paths), cpu_count())
+
+    if workers <= 1:
+        filehashes = [compute_file_hash(path) for path in file_paths]
+    else:
+        pool = ThreadPool(workers)
+        try:
+            filehashes = pool.map(compute_file_hash, file_paths)
+        finally:
+            pool.close()
+            pool.join()
+
+    return dict(zip(file_paths, filehashes))
+
+
 def compute_json_hash(json_dict):
-    json_str = json.dumps(json_dict)
+    json_str = json.dumps(json_dict, sort_keys=True)
     json_hash = hashlib.sha1()
     json_hash.update(json_str)
     return json_hash.hexdigest()
@@ -41,82 +74,536 @@ class FileInterface(object):
             f.write(contents)
 
 
+# how datasets are stored unless output_keys or the transform's
+# hdf5_options say otherwise
+DEFAULT_HDF5_OPTIONS = {
+    'compression': 'gzip',
+    'compression_opts': 7,
+    'shuffle': False,
+    'chunks': True
+}
+
+
 class HDF5Interface(FileInterface):
 
     def __init__(self, filename):
         super(HDF5Interface, self).__init__(filename)
         self.write_chunk_size = {}
+        # set from the hdf5_options parameter of the transform writing this
+        self.options = {}
+        # a CheckpointJournal, when the stage writing this checkpoints
+        self.journal = None
 
     def open(self, mode='r'):
+        if mode == 'w' and self.journal is not None:
+            # the file is truncated, so nothing written before is kept
+            self.journal.reset()
         h5py_file = h5py.File(self.filename, mode)
         return h5py_file
 
-    def create_dataset(self, h5py_file, output_keys, rows=None):
+    def open_output(self, output_keys, rows=None, resizable=False):
+        """
+        Open the file to write output_keys to, carrying on with it if the
+        journal is being resumed, otherwise creating the datasets afresh
+        """
+        if self.journal is not None and self.journal.resumed:
+            return self.open(mode='r+')
+
+        h5py_file = self.open(mode='w')
+        self.create_dataset(h5py_file, output_keys, rows, resizable)
+        return h5py_file
+
+    def is_committed(self, start, stop, keys):
+        """
+        Whether rows start to stop of keys were written by an earlier,
+        resumed run
+        """
+        return self.journal is not None and self.journal.is_committed(start, stop, keys)
+
+    def committed_rows(self, keys):
+        """
+        How many rows of keys, from the first, were written by an earlier,
+        resumed run
+        """
+        if self.journal is None:
+            return 0
+        return self.journal.committed_stop(keys)
+
+    def trim(self, h5py_file, keys, rows):
+        """
+        Shrink resizable datasets to their first rows
+        """
+        for key in keys:
+            h5py_file[key].resize(rows, axis=0)
+
+    def create_dataset(self, h5py_file, output_keys, rows=None, resizable=False):
+        """
+        Create a dataset for each of output_keys, which can later be resized
+        to any number of rows if resizable.  Besides its dtype and shape,
+        each key may set how it is stored, overriding the transform's
+        hdf5_options:
+
+        compression: "gzip", "lzf" or "none"
+        compression_opts: the gzip level, 0-9
+        shuffle: whether to apply the byte shuffle filter before compressing
+        chunk_rows: store chunks of this many whole rows, suited to reading
+            rows at a time
+        chunks: an explicit chunk shape, true to let h5py choose, or false
+            to store the dataset contiguously, so if uncompressed it can be
+            memory-mapped by lazy()
+        """
         logging.info("Creating HDF5 dataset {0}".format(self.filename))
         for key, parameters in output_keys.iteritems():
             if rows:
-                shape = [rows] + parameters['shape'][1:]
+                shape = [rows] + list(parameters['shape'][1:])
             else:
                 shape = parameters['shape']
 
+            options = self._storage_options(key, shape, parameters)
+            if resizable:
+                # h5py chooses chunks if none are given
+                options['maxshape'] = (None,) + tuple(shape[1:])
             h5py_file.create_dataset(
                 key,
                 shape,
                 dtype=np.dtype(parameters['dtype']),
-                chunks=True,
-                compression="gzip",
-                compression_opts=7
+                **options
             )
 
+    def _storage_options(self, key, shape, parameters):
+        options = dict(DEFAULT_HDF5_OPTIONS)
+        options.update(self.options)
+        options.update(
+            (k, v) for k, v in parameters.iteritems()
+            if k in DEFAULT_HDF5_OPTIONS or k == 'chunk_rows'
+        )
+
+        chunk_rows = options.pop('chunk_rows', None)
+        if chunk_rows and 'chunks' not in parameters:
+            chunk_rows = max(1, min(chunk_rows, shape[0]))
+            options['chunks'] = tuple([chunk_rows] + list(shape[1:]))
+            # write whole chunks at a time
+            self.write_chunk_size[key] = chunk_rows * max(1, 500 / chunk_rows)
+        elif isinstance(options['chunks'], list):
+            options['chunks'] = tuple(options['chunks'])
+        elif options['chunks'] is False:
+            options['chunks'] = None
+
+        if options['compression'] in (None, 'none'):
+            options['compression'] = None
+            options['compression_opts'] = None
+        elif options['compression'] != 'gzip':
+            options['compression_opts'] = None
+
+        if 0 in shape:
+            # h5py can not chunk an empty dataset
+            options = {'chunks': None, 'compression': None, 'compression_opts': None, 'shuffle': False}
+
+        return options
+
     def save(self, h5py_file):
         h5py_file.close()
 
+    @traced('hdf5.read_all', 'io')
     def read_all(self, keys):
         h5py_file = self.open()
-        contents = {key: h5py_file[key].value for key in keys}
+        contents = {key: h5py_file[key][()] for key in keys}
         self.close(h5py_file)
         return contents
 
+    def lazy(self, h5py_file, key):
+        """
+        Access a dataset without reading it into memory, see LazyDataset
+        """
+        return LazyDataset(h5py_file[key], self.filename)
+
     def write_chunk(self, h5py_file, out, output_keys, start_row=0):
+        """
+        Write the rows of out to output_keys from start_row, committing them
+        to the journal if the file has one
+        """
+        written_stop = start_row
         for key in output_keys.keys():
-            chunk_size = min(self.write_chunk_size.get(key, 500), out[key].shape[0])
-            output_shape = [chunk_size] + list(output_keys[key]['shape'][1:])
-            for i in xrange(start_row, start_row + out[key].shape[0], chunk_size):
-                last_index = i + chunk_size
-                last_index_out = min(last_index - start_row, out[key].shape[0])
-                h5py_file[key][i:last_index] = out[key][i-start_row:last_index_out].reshape(output_shape)
+            rows = out[key].shape[0]
+            if rows == 0:
+                continue
+            chunk_size = min(self.write_chunk_size.get(key, 500), rows)
+            with span('hdf5.write_chunk', 'io', key=key, start_row=start_row, rows=rows):
+                for i in xrange(0, rows, chunk_size):
+                    last_index = min(i + chunk_size, rows)
+                    output_shape = [last_index - i] + list(output_keys[key]['shape'][1:])
+                    h5py_file[key][start_row + i:start_row + last_index] = out[key][i:last_index].reshape(output_shape)
+            written_stop = max(written_stop, start_row + rows)
+
+        if self.journal is not None and written_stop > start_row:
+            with span('hdf5.commit', 'io', start_row=start_row, stop=written_stop):
+                h5py_file.flush()
+                self.journal.commit(start_row, written_stop, output_keys.keys())
+
+    def read_rows(self, dataset, rows, max_run_bytes=64 << 20):
+        """
+        Read rows of an h5py dataset, in the order given, without h5py's
+        slow point selection.  The rows are sorted and merged into runs
+        aligned to the dataset's chunks, each run is read with one slice so
+        every chunk is decompressed at most once, and the requested rows are
+        gathered from them in numpy.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if rows.shape[0] == 0:
+            return np.empty((0,) + dataset.shape[1:], dtype=dataset.dtype)
+
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        row_bytes = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:]))
+        if dataset.chunks:
+            block_rows = dataset.chunks[0]
+        else:
+            # contiguous datasets have no chunks to align to, so just avoid
+            # reading many small runs
+            block_rows = max(1, (1 << 20) / max(row_bytes, 1))
+        max_run_blocks = max(1, max_run_bytes / max(block_rows * row_bytes, 1))
+
+        gathered = np.empty((unique_rows.shape[0],) + dataset.shape[1:], dtype=dataset.dtype)
+        with span('hdf5.read_rows', 'io', key=dataset.name, rows=rows.shape[0]):
+            for start, stop, first, last in plan_row_reads(unique_rows, block_rows, max_run_blocks, dataset.shape[0]):
+                run = dataset[start:stop]
+                gathered[first:last] = run[unique_rows[first:last] - start]
+
+        return gathered[inverse]
+
+    def append(self, h5py_group, out):
+        """
+        Append rows to resizable datasets in h5py_group, creating them on
+        first use
+        """
+        for key, values in out.iteritems():
+            if key not in h5py_group:
+                h5py_group.create_dataset(
+                    key,
+                    data=values,
+                    maxshape=(None,) + values.shape[1:],
+                    chunks=True
+                )
+            else:
+                dataset = h5py_group[key]
+                start_row = dataset.shape[0]
+                dataset.resize(start_row + values.shape[0], axis=0)
+                dataset[start_row:] = values
 
     def close(self, h5py_file):
         h5py_file.close()
 
 
+class LazyDataset(object):
+    """
+    Read access to an HDF5 dataset that avoids copying it into memory.
+
+    Datasets stored contiguously and uncompressed are memory-mapped, so
+    indexing them returns numpy views backed by the file.  Chunked or
+    compressed datasets are read on demand, a block of rows at a time when
+    iterated with iter_blocks.
+    """
+
+    def __init__(self, dataset, filename):
+        self.dataset = dataset
+        self.shape = dataset.shape
+        self.dtype = dataset.dtype
+        self.array = None
+
+        if dataset.chunks is None and dataset.compression is None \
+                and dataset.dtype.kind not in ('O', 'V'):
+            offset = dataset.id.get_offset()
+            if offset is not None and dataset.size > 0:
+                self.array = np.memmap(
+                    filename,
+                    mode='r',
+                    dtype=dataset.dtype,
+                    offset=offset,
+                    shape=dataset.shape
+                )
+
+    @property
+    def is_memory_mapped(self):
+        return self.array is not None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if self.array is not None:
+            return self.array[index]
+        return self.dataset[index]
+
+    def read(self):
+        """
+        The whole dataset as an array: a view of the file if memory-mapped,
+        otherwise a copy in memory
+        """
+        if self.array is not None:
+            return self.array
+        return self.dataset[()]
+
+    def block_rows(self, max_block_bytes=32 << 20):
+        """
+        Rows per block when iterating, a whole number of chunks if chunked
+        """
+        row_bytes = max(1, self.dtype.itemsize * int(np.prod(self.shape[1:])))
+        rows = max(1, max_block_bytes / row_bytes)
+        if self.dataset.chunks:
+            chunk_rows = self.dataset.chunks[0]
+            rows = max(chunk_rows, rows - rows % chunk_rows)
+
+        return rows
+
+    def iter_blocks(self, block_rows=None, start=0, stop=None):
+        """
+        Yield (start, stop, rows) for consecutive blocks of rows
+        """
+        block_rows = block_rows or self.block_rows()
+        stop = self.shape[0] if stop is None else stop
+        for block_start in xrange(start, stop, block_rows):
+            block_stop = min(block_start + block_rows, stop)
+            with span('hdf5.read_block', 'io', start=block_start, stop=block_stop):
+                rows = self[block_start:block_stop]
+            yield block_start, block_stop, rows
+
+
+def plan_row_reads(rows, block_rows, max_run_blocks, row_count):
+    """
+    Group sorted, unique row indexes into runs of whole blocks of block_rows.
+    Rows in the same or neighbouring blocks share a run, and no run spans
+    more than max_run_blocks blocks.  Yields (start, stop, first, last) for
+    each run: the slice of the dataset to read, and the slice of rows it
+    covers.
+    """
+    blocks = rows // block_rows
+    breaks = np.flatnonzero(np.diff(blocks) > 1) + 1
+    run_starts = np.concatenate([[0], breaks])
+    run_ends = np.concatenate([breaks, [rows.shape[0]]])
+
+    for run_start, run_end in zip(run_starts, run_ends):
+        first_block = blocks[run_start]
+        last_block = blocks[run_end - 1]
+        # split runs that would read too much at once
+        limits = np.arange(first_block + max_run_blocks, last_block + 1, max_run_blocks)
+        splits = run_start + np.searchsorted(blocks[run_start:run_end], limits)
+        for first, last in zip(np.concatenate([[run_start], splits]), np.concatenate([splits, [run_end]])):
+            if first == last:
+                continue
+            start = int(blocks[first] * block_rows)
+            stop = int(min((blocks[last - 1] + 1) * block_rows, row_count))
+            yield start, stop, int(first), int(last)
+
+
 COMPRESSION_FORMATS = {
     'gz': 'gzip',
     'bz2': 'bz2'
 }
 
+COMPRESSED_FILE_OPENERS = {
+    'gzip': gzip.GzipFile,
+    'bz2': bz2.BZ2File
+}
 
+
+class CSVRowIndex(object):
+    """
+    The byte offset at which each row of a csv file starts, kept in a file
+    in index_dir named by the sha1 of the csv's real path, so rows can be
+    counted and seeked to without scanning the file.  Without an index_dir
+    the index is only kept in memory.
+
+    The index is rebuilt whenever the file's sha1 no longer matches, and the
+    hash is only recomputed when the file's size or mtime have changed.
+    Offsets of compressed files are into the decompressed stream, so seeking
+    them still decompresses everything before the row.  Rows are lines, so
+    quoted values must not contain newlines.
+    """
+
+    def __init__(self, filename, compression=None, index_dir=None):
+        self.filename = filename
+        self.index_filename = None
+        if index_dir:
+            self.index_filename = os.path.join(
+                index_dir,
+                '{0}.npz'.format(hashlib.sha1(os.path.realpath(filename)).hexdigest())
+            )
+        self.compression = compression
+        self.offsets = None
+
+        stat = os.stat(filename)
+        self.signature = np.array([stat.st_size, stat.st_mtime])
+        self._load()
+
+    def __len__(self):
+        # the first offset is the header
+        return self.offsets.shape[0] - 1
+
+    def open(self):
+        if self.compression:
+            return COMPRESSED_FILE_OPENERS[self.compression](self.filename, 'rb')
+        return open(self.filename, 'rb')
+
+    def row_range(self, start, stop):
+        """
+        The byte range, [start, stop), holding the rows start to stop, with
+        a stop of None when it is the end of the file.  start must be a row
+        of the file.
+        """
+        if stop >= len(self):
+            return self.offsets[start + 1], None
+        return self.offsets[start + 1], self.offsets[stop + 1]
+
+    def _load(self):
+        if self.index_filename and os.path.exists(self.index_filename):
+            try:
+                stored = np.load(self.index_filename)
+                offsets = stored['offsets']
+                sha1 = str(stored['sha1'])
+                signature = stored['signature']
+            except (IOError, ValueError, KeyError):
+                logging.warning(
+                    "Ignoring corrupt row index {0}".format(self.index_filename)
+                )
+            else:
+                if np.array_equal(signature, self.signature):
+                    self.offsets = offsets
+                    return
+                sha1_now = compute_file_hash(self.filename)
+                if sha1_now == sha1:
+                    # touched but unchanged, so just update the signature
+                    self.offsets = offsets
+                    self._save(sha1_now)
+                    return
+
+        self.offsets = self._build()
+        self._save(compute_file_hash(self.filename))
+
+    @traced('csv.index_rows', 'io')
+    def _build(self):
+        logging.debug("Indexing rows of {0}".format(self.filename))
+        offsets = [np.zeros(1, dtype=np.int64)]
+        position = 0
+        last_byte = '\n'
+        with self.open() as f:
+            for block in iter(partial(f.read, HASH_BUFFER_SIZE), ''):
+                newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n'))
+                offsets.append(newlines.astype(np.int64) + position + 1)
+                position += len(block)
+                last_byte = block[-1]
+
+        offsets = np.concatenate(offsets)
+        if last_byte == '\n' and offsets.shape[0] > 1:
+            # a row can not start at the end of the file
+            offsets = offsets[:-1]
+
+        return offsets
+
+    def _save(self, sha1):
+        if not self.index_filename:
+            return
+
+        tmp_filename = '{0}.tmp'.format(self.index_filename)
+        try:
+            index_dir = os.path.dirname(self.index_filename)
+            if not os.path.isdir(index_dir):
+                try:
+                    os.makedirs(index_dir)
+                except OSError:
+                    # another stage indexing a csv made it first
+                    if not os.path.isdir(index_dir):
+                        raise
+            with open(tmp_filename, 'wb') as f:
+                np.savez(f, offsets=self.offsets, sha1=sha1, signature=self.signature)
+            os.rename(tmp_filename, self.index_filename)
+        except (IOError, OSError) as e:
+            # eg. a read-only cache directory, the index is just rebuilt
+            logging.warning(
+                "Unable to save row index {0}: {1}".format(self.index_filename, e)
+            )
+
+
+# pandas takes a while to import, so it is only imported by the methods that
+# parse csv files, keeping it out of runs where every stage is cached
 class CSVInterface(FileInterface):
 
+    def __init__(self, filename):
+        super(CSVInterface, self).__init__(filename)
+        # set by Data to the repo's cache, where the row index is kept
+        self.index_dir = None
+        self._row_index = None
+
+    @property
+    def row_index(self):
+        if self._row_index is None:
+            self._row_index = CSVRowIndex(
+                self.filename,
+                self._get_compression(),
+                self.index_dir
+            )
+        return self._row_index
+
     def get_row_count(self):
-        row_count = sum(1 for line in open(self.filename))
-        return row_count - 1
+        return len(self.row_index)
 
     def _get_compression(self):
         extension = os.path.basename(self.filename).split('.')[-1]
         return COMPRESSION_FORMATS.get(extension, None)
 
-    def read_chunk(self, chunk_size, keys=['url']):
-        df = pd.read_csv(
-            self.filename,
-            compression=self._get_compression(),
-            usecols=keys,
-            chunksize=chunk_size
-        )
-        for chunk in df:
-            yield chunk
+    def read_chunk(self, chunk_size, keys=['url'], start=0, stop=None):
+        """
+        Yield DataFrames of up to chunk_size rows, optionally only of the
+        rows start to stop
+        """
+        import pandas as pd
+
+        if start == 0 and stop is None:
+            df = pd.read_csv(
+                self.filename,
+                compression=self._get_compression(),
+                usecols=keys,
+                chunksize=chunk_size
+            )
+            chunks = iter(df)
+            while True:
+                with span('csv.read_chunk', 'io', rows=chunk_size):
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    return
+                yield chunk
+
+        stop = len(self.row_index) if stop is None else min(stop, len(self.row_index))
+        for chunk_start in xrange(start, stop, chunk_size):
+            yield self.read_rows(chunk_start, min(chunk_start + chunk_size, stop), keys)
+
+    def read_rows(self, start, stop, keys=None):
+        """
+        Read the rows start to stop into a DataFrame, seeking straight to
+        them using the row index
+        """
+        import pandas as pd
+
+        stop = min(stop, len(self.row_index))
+        with span('csv.read_rows', 'io', start=start, stop=stop):
+            with self.row_index.open() as f:
+                header = f.readline()
+                if start >= stop:
+                    rows = ''
+                else:
+                    byte_start, byte_stop = self.row_index.row_range(start, stop)
+                    f.seek(byte_start)
+                    if byte_stop is None:
+                        rows = f.read()
+                    else:
+                        rows = f.read(byte_stop - byte_start)
+
+            df = pd.read_csv(StringIO(header + rows), usecols=keys)
+        df.index = pd.RangeIndex(start, start + df.shape[0])
+        return df
 
+    @traced('csv.read_all', 'io')
     def read_all(self, **kwargs):
+        import pandas as pd
+
         df = pd.read_csv(
             self.filename,
             compression=self._get_compression(),
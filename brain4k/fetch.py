@@ -0,0 +1,233 @@
+import os
+import time
+import shutil
+import hashlib
+import urllib2
+import logging
+import tempfile
+import urlparse
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from tracing import span
+
+
+class ConcurrentFetcher(object):
+    """
+    Load a batch of urls on a pool of threads.
+
+    loader is called as loader(url, timeout) and may raise to signal a
+    failed fetch, which is retried up to retries times.  Results are returned
+    in the same order as the urls, with None for any url that could not be
+    loaded.
+    """
+
+    def __init__(self, loader, workers=8, timeout=10, retries=2, retry_backoff=0.5):
+        if workers < 1:
+            raise ValueError("A fetcher needs at least one worker")
+
+        self.loader = loader
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self._pool = None
+
+    @classmethod
+    def from_parameters(cls, loader, parameters):
+        """
+        Build a fetcher from the fetch_* keys of a transform's parameters
+        """
+        return cls(
+            loader,
+            workers=parameters.get('fetch_workers', 8),
+            timeout=parameters.get('fetch_timeout', 10),
+            retries=parameters.get('fetch_retries', 2),
+            retry_backoff=parameters.get('fetch_retry_backoff', 0.5)
+        )
+
+    def fetch(self, urls):
+        urls = list(urls)
+        if self.workers == 1 or len(urls) <= 1:
+            return [self._load(url) for url in urls]
+
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers)
+
+        return self._pool.map(self._load, urls)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _load(self, url):
+        for attempt in xrange(self.retries + 1):
+            try:
+                return self.loader(url, self.timeout)
+            except Exception as e:
+                if attempt < self.retries:
+                    time.sleep(self.retry_backoff * 2 ** attempt)
+                else:
+                    logging.warning(
+                        "Failed to fetch {0} after {1} attempts: {2}"
+                        .format(url, attempt + 1, e)
+                    )
+
+        return None
+
+
+def is_url(path):
+    return bool(urlparse.urlparse(path).scheme)
+
+
+def fetch_to_file(url, timeout, suffix=''):
+    """
+    Download url into a named temporary file and return its path.
+    The caller is responsible for removing it.
+    """
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            response = urllib2.urlopen(url, timeout=timeout)
+            try:
+                shutil.copyfileobj(response, f)
+            finally:
+                response.close()
+    except Exception:
+        os.remove(path)
+        raise
+
+    return path
+
+
+DOWNLOAD_BUFFER_SIZE = 1 << 20
+
+
+class PartialDownload(object):
+    """
+    A download into filename.part that can be carried on from where it
+    stopped, hashing the bytes as they are written
+    """
+
+    def __init__(self, url, filename):
+        self.url = url
+        self.filename = filename
+        self.part_filename = filename + '.part'
+        self.digest = hashlib.sha1()
+        self.offset = 0
+
+        if os.path.exists(self.part_filename):
+            # left by an interrupted run, so hash what it fetched
+            with open(self.part_filename, 'rb') as f:
+                for block in iter(partial(f.read, DOWNLOAD_BUFFER_SIZE), ''):
+                    self.digest.update(block)
+                    self.offset += len(block)
+
+    def resume(self, timeout):
+        """
+        Fetch the rest of the file, using an HTTP Range request if part of
+        it has already been fetched
+        """
+        request = urllib2.Request(self.url)
+        if self.offset:
+            request.add_header('Range', 'bytes={0}-'.format(self.offset))
+
+        try:
+            response = urllib2.urlopen(request, timeout=timeout)
+        except urllib2.HTTPError as e:
+            if e.code == 416 and self.offset:
+                # nothing is left to fetch
+                return
+            raise
+
+        try:
+            if self.offset and response.getcode() != 206:
+                logging.info("{0} does not support resuming, starting over".format(self.url))
+                self.digest = hashlib.sha1()
+                self.offset = 0
+            elif self.offset:
+                logging.info("Resuming {0} from {1} bytes".format(self.url, self.offset))
+
+            length = response.info().getheader('Content-Length')
+            expected = self.offset + int(length) if length else None
+
+            with open(self.part_filename, 'ab') as f:
+                # drop anything written after the last block was counted
+                f.truncate(self.offset)
+                for block in iter(partial(response.read, DOWNLOAD_BUFFER_SIZE), ''):
+                    f.write(block)
+                    self.digest.update(block)
+                    self.offset += len(block)
+        finally:
+            response.close()
+
+        # httplib returns a short read rather than raising when the
+        # connection drops, so check the whole body arrived
+        if expected is not None and self.offset < expected:
+            raise IOError(
+                "Connection closed after {0} of {1} bytes"
+                .format(self.offset, expected)
+            )
+
+    def finish(self, sha1):
+        """
+        Move the complete file into place if its hash matches sha1
+        """
+        if self.digest.hexdigest() != sha1:
+            os.remove(self.part_filename)
+            raise Exception(
+                "SHA1 hash of {0} does not match the one "
+                "specified in pipeline.json".format(self.filename)
+            )
+        os.rename(self.part_filename, self.filename)
+
+
+def download_file(url, filename, sha1, timeout=60, retries=3, retry_backoff=1.0):
+    """
+    Download url to filename, resuming after interruptions and verifying
+    its sha1 as it streams in.  Nothing is written to filename itself
+    until the whole file has arrived and been verified.
+    """
+    download = PartialDownload(url, filename)
+    for attempt in xrange(retries + 1):
+        try:
+            with span('fetch.download', 'io', url=url, offset=download.offset):
+                download.resume(timeout)
+            break
+        except (IOError, urllib2.URLError) as e:
+            if attempt == retries or \
+                    isinstance(e, urllib2.HTTPError) and e.code < 500:
+                raise
+            logging.warning(
+                "Download of {0} interrupted at {1} bytes, retrying: {2}"
+                .format(url, download.offset, e)
+            )
+            time.sleep(retry_backoff * 2 ** attempt)
+
+    download.finish(sha1)
+    logging.info(
+        "Downloaded {0} ({1:.1f}MB)".format(url, download.offset / float(1 << 20))
+    )
+
+
+def download_missing(data, workers=4, timeout=60):
+    """
+    Download every remote blob in data that is not yet on disk, several at
+    a time
+    """
+    missing = {}
+    for datum in data:
+        if datum.url and not os.path.exists(datum.filename):
+            missing[datum.filename] = datum
+    if not missing:
+        return
+
+    logging.info("Fetching {0} remote blobs".format(len(missing)))
+    pool = ThreadPool(max(1, min(workers, len(missing))))
+    try:
+        pool.map(lambda datum: datum.prepare(timeout), missing.values())
+    finally:
+        pool.close()
+        pool.join()
@@ -21,6 +21,7 @@ def render_pipeline(config, transforms, pipeline_name):
 
     pipeline_template = template_env.get_template('templates/pipeline.dot')
     pipeline_dot = pipeline_template.render(transforms=transforms)
+    pipeline_figure.prepare()
     pipeline_figure.io.save(pipeline_dot)
 
     uglified_pipeline = re.sub('[\n\t\s]+', ' ', pipeline_dot)
@@ -43,6 +44,7 @@ def render_pipeline(config, transforms, pipeline_name):
             except ImportError:
                 short_url = pipeline_image_url
 
+    pipeline_md.prepare()
     pipeline_md.io.write(
         'templates/pipeline_figure.md',
         {'short_url': short_url, 'pipeline_name': pipeline_name}
@@ -108,6 +110,7 @@ def render_dot_locally(dot_string, config, pipeline_name):
             config['repo_path']
         )
 
+        rendered_pipeline.prepare()
         pipeline_graph.draw(rendered_pipeline.filename, prog='dot')
 
         return relative_path
@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import logging
+import threading
+
+from data_interfaces import compute_file_hashes
+
+
+# a file modified within this many seconds of being hashed may change again
+# without its mtime moving, so its cached hash is not trusted
+RACY_INTERVAL = 2.0
+
+
+class FileHashCache(object):
+    """
+    Persistent store of file hashes, so blobs that have not changed since the
+    last run are not re-hashed.
+
+    Entries are keyed by the real path of the file and are only reused while
+    its size, mtime and inode all still match.
+    """
+
+    def __init__(self, cache_path, verify=False):
+        self.cache_path = cache_path
+        self.verify = verify
+        self.entries = self._load()
+        self._dirty = False
+        # stages running on worker threads may hash files at the same time
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if not os.path.exists(self.cache_path):
+            return {}
+
+        try:
+            with open(self.cache_path, 'r') as f:
+                return json.loads(f.read())
+        except ValueError:
+            logging.warning(
+                "Ignoring corrupt file hash cache {0}".format(self.cache_path)
+            )
+            return {}
+
+    def compute_file_hash(self, file_path):
+        return self.compute_file_hashes([file_path])[file_path]
+
+    def compute_file_hashes(self, file_paths):
+        """
+        Returns a dict mapping each path to its sha1 hash, hashing any files
+        without a valid cache entry in parallel
+        """
+        filehashes = {}
+        stale = {}
+        for file_path in file_paths:
+            path = os.path.realpath(file_path)
+            stat = os.stat(path)
+            signature = [stat.st_size, stat.st_mtime, stat.st_ino]
+
+            with self._lock:
+                entry = self.entries.get(path, None)
+            if not self.verify and entry and entry['signature'] == signature \
+                    and entry['hashed_at'] - stat.st_mtime > RACY_INTERVAL:
+                filehashes[file_path] = entry['sha1']
+            else:
+                stale[file_path] = (path, signature)
+
+        if not stale:
+            return filehashes
+
+        hashed_at = time.time()
+        computed = compute_file_hashes(stale.keys())
+        with self._lock:
+            for file_path, (path, signature) in stale.iteritems():
+                filehash = computed[file_path]
+                entry = self.entries.get(path, None)
+                if entry and self.verify and entry['signature'] == signature \
+                        and entry['sha1'] != filehash:
+                    logging.warning(
+                        "Cached hash for {0} was stale, file changed in place"
+                        .format(path)
+                    )
+
+                self.entries[path] = {
+                    'signature': signature,
+                    'sha1': filehash,
+                    'hashed_at': hashed_at
+                }
+                filehashes[file_path] = filehash
+            self._dirty = True
+
+        return filehashes
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        if not self._dirty:
+            return
+
+        # forget files that have since been removed
+        for path in [p for p in self.entries if not os.path.exists(p)]:
+            del self.entries[path]
+
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps(self.entries, sort_keys=True, indent=4))
+        os.rename(tmp_path, self.cache_path)
+        self._dirty = False
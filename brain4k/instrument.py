@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import time
+import resource
+from datetime import datetime
+
+from data import Data
+
+
+class Measurement(object):
+    """
+    Wall and CPU time, peak RSS and disk IO used between entering and
+    leaving it.
+
+    These are read for the whole process, so while stages run at the same
+    time with --jobs they include one another's use.  CPU time includes
+    child processes, such as feature extraction workers, that have been
+    waited for.  Peak RSS can only be measured for the span alone on Linux,
+    where the high water mark is reset on entering; elsewhere it is the
+    peak of the process so far.
+    """
+
+    def __enter__(self):
+        reset_peak_rss()
+        self.start_wall = time.time()
+        self.start_cpu = cpu_time()
+        self.start_io = disk_io()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.wall_time = time.time() - self.start_wall
+        self.cpu_time = cpu_time() - self.start_cpu
+        self.peak_rss = peak_rss()
+        stop_io = disk_io()
+        self.io = {key: stop_io[key] - self.start_io[key] for key in stop_io}
+
+    def as_dict(self):
+        return dict(
+            wall_time=self.wall_time,
+            cpu_time=self.cpu_time,
+            peak_rss=self.peak_rss,
+            **self.io
+        )
+
+
+def cpu_time():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        pass
+
+
+def peak_rss():
+    """
+    Peak resident set size in bytes
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) << 10
+    except IOError:
+        pass
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on OS X and kilobytes elsewhere
+    return maxrss if sys.platform == 'darwin' else maxrss << 10
+
+
+def disk_io():
+    """
+    Bytes this process has read from and written to storage, where the
+    platform reports them
+    """
+    counters = {}
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                name, value = line.split(':')
+                if name in ('read_bytes', 'write_bytes'):
+                    counters['disk_' + name] = int(value)
+    except IOError:
+        pass
+
+    return counters
+
+
+def blob_states(data):
+    """
+    The size and modification state of each file blob in data, to compare
+    before and after a stage runs
+    """
+    states = {}
+    for datum in data:
+        if datum.data_type == 'argument' or not os.path.exists(datum.filename):
+            continue
+        stat = os.stat(datum.filename)
+        states[datum.name] = (stat.st_size, stat.st_mtime, stat.st_ino)
+
+    return states
+
+
+def blob_io(inputs, outputs, before, after):
+    """
+    Bytes read from and written to each blob by a stage.  These are taken
+    from the blobs' sizes: a stage is counted as reading the whole of each
+    input, and writing the whole of each output it changed.
+    """
+    blobs = []
+    for datum in inputs:
+        if datum.name in after:
+            blobs.append({'name': datum.name, 'bytes_read': after[datum.name][0]})
+    for datum in outputs:
+        if datum.name in after and before.get(datum.name) != after[datum.name]:
+            blobs.append({'name': datum.name, 'bytes_written': after[datum.name][0]})
+
+    return blobs
+
+
+class RunLog(object):
+    """
+    One json record per line for each run of a pipeline, with the
+    measurements of each of its stages
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @classmethod
+    def for_repo(cls, repo_path):
+        return cls(os.path.join(repo_path, 'cache', 'run_log.jsonl'))
+
+    def append(self, record):
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def last_run(self, pipeline_name):
+        if not os.path.exists(self.filename):
+            return None
+
+        last = None
+        with open(self.filename, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('pipeline') == pipeline_name:
+                    last = record
+
+        return last
+
+
+def start_run(pipeline_name, stage_count, jobs):
+    return {
+        'pipeline': pipeline_name,
+        'started': datetime.utcnow().isoformat() + 'Z',
+        'jobs': jobs,
+        'status': 'running',
+        'stages': [{'stage': index + 1, 'status': 'not run'} for index in xrange(stage_count)]
+    }
+
+
+def render_performance(config, pipeline_name, run):
+    """
+    Write a markdown table of the run's stage measurements, returning its
+    filename
+    """
+    performance_md = Data(
+        'performance',
+        config,
+        {
+            'local_filename': '{0}_performance.md'.format(pipeline_name),
+            'data_type': 'markdown'
+        }
+    )
+
+    rows = []
+    for stage in run['stages']:
+        row = {
+            'stage': stage['stage'],
+            'transform': stage.get('transform', ''),
+            'status': stage['status'],
+        }
+        if 'wall_time' in stage:
+            row.update({
+                'wall_time': '{0:.2f}s'.format(stage['wall_time']),
+                'cpu_time': '{0:.2f}s'.format(stage['cpu_time']),
+                'peak_rss': '{0:.0f}MB'.format(stage['peak_rss'] / float(1 << 20)),
+                'bytes_read': format_bytes(sum(blob.get('bytes_read', 0) for blob in stage['blobs'])),
+                'bytes_written': format_bytes(sum(blob.get('bytes_written', 0) for blob in stage['blobs'])),
+                'rows_per_second': '{0:.0f}'.format(stage['rows_per_second']) if 'rows_per_second' in stage else ''
+            })
+        rows.append(row)
+
+    performance_md.prepare()
+    performance_md.io.write(
+        'templates/performance.md',
+        {'pipeline_name': pipeline_name, 'run': run, 'rows': rows}
+    )
+
+    return performance_md.filename
+
+
+def format_bytes(size):
+    return '{0:.1f}MB'.format(size / float(1 << 20))
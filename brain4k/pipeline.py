@@ -1,101 +1,196 @@
 import os
 import json
+import time
 import logging
 from itertools import chain
 
 from data import path_to_file, Data
-from transforms import TRANSFORMS
+from fetch import download_missing
+from hash_cache import FileHashCache
+from build_cache import BuildCache, unlink_shared_outputs
+from scheduler import StageScheduler, stage_dependencies, upstream_stages
+from transforms import TRANSFORMS, PipelineStage
 from graph import render_pipeline, pipeline_md_for_name
+from instrument import RunLog, start_run, render_performance
+from tracing import span
 
 
-def execute_pipeline(repo_path, pipeline_name, pipeline_args=[], cache_stages=True, force_render_metrics=False):
+def execute_pipeline(repo_path, pipeline_name, pipeline_args=[], cache_stages=True, force_render_metrics=False, verify_hashes=False, jobs=1, explain=False, use_build_cache=True, resume=False):
     with open(path_to_file(repo_path, 'pipeline.json'), 'r+') as config_file:
         config = json.loads(config_file.read(), encoding='utf-8')
         config['repo_path'] = repo_path
 
         init_env(repo_path)
+        hash_cache = FileHashCache(
+            path_to_file(repo_path, 'cache', 'file_hashes.json'),
+            verify=verify_hashes
+        )
 
-        transforms = []
-
-        if len(config['pipelines']) == 1:
-            pipeline_name = config['pipelines'].keys()[0]
-
-        named_stages = config['pipelines'].get(pipeline_name, None)
-
-        if not named_stages:
-            raise ValueError(
-                "Pipeline.json does not contain a stage named '{0}'"
-                .format(pipeline_name)
-            )
-        else:
-            pipeline_is_ephemeral = named_stages.get('ephemeral', False)
-            named_stages = named_stages['stages']
-
-        for stage in named_stages:
-            module_name, class_name = TRANSFORMS[config['transforms'][stage['transform']]['transform_type']].rsplit('.',1)
-            module = __import__(module_name, fromlist=[class_name])
-            transform_cls = getattr(module, class_name)
-            transform = transform_cls(stage, config, pipeline_is_ephemeral)
-            transforms.append(transform)
+        pipeline_name, named_stages, pipeline_is_ephemeral = select_pipeline(config, pipeline_name)
+        # the transforms' modules are only imported for stages that run
+        transforms = describe_stages(config, named_stages, pipeline_is_ephemeral)
 
         if pipeline_is_ephemeral:
             cached_stages = [False for s in xrange(len(transforms))]
+            reasons = ["the pipeline is ephemeral" for s in xrange(len(transforms))]
+        elif not cache_stages:
+            cached_stages = [False for s in xrange(len(transforms))]
+            reasons = ["caching is disabled" for s in xrange(len(transforms))]
         else:
-            cached_stages = detect_changes(transforms, named_stages)
-        metrics_updated = False
-
-        for stage_index, (transform, stage, stage_is_cached) in enumerate(zip(transforms, named_stages, cached_stages)):
-            if cache_stages and stage_is_cached:
+            cached_stages, reasons = detect_changes(
+                transforms,
+                named_stages,
+                hash_cache,
+                upstream_stages(named_stages, config)
+            )
+            hash_cache.save()
+
+        if explain:
+            explain_changes(transforms, cached_stages, reasons)
+        state = {
+            'pipeline_args': pack_pipeline_args(transforms[0], pipeline_args),
+            'metrics_updated': False
+        }
+        # computed as each stage starts, and recorded once it completes
+        build_keys = {}
+
+        # what each stage used, saved to the run log
+        run = start_run(pipeline_name, len(transforms), jobs)
+        stages_to_run = []
+        for stage_index, stage_is_cached in enumerate(cached_stages):
+            run['stages'][stage_index]['transform'] = transforms[stage_index].transform_name
+            if stage_is_cached:
                 logging.info("Skipping stage {0} (cached)".format(stage_index + 1))
-                continue
+                run['stages'][stage_index]['status'] = 'cached'
             else:
-                logging.info("Starting stage {0}".format(stage_index + 1))
-                methods = stage.get('actions', [])
-
-                # if the transform is expecting any in-memory arguments passed
-                # to it, make sure they are passed
-                input_arguments = [t for t in transform.inputs if t.data_type == 'argument']
-                if pipeline_args and input_arguments:
-                    if len(pipeline_args) != len(input_arguments):
-                        raise ValueError(
-                            "Argument mismatch: {0} passed arguments {1}"
-                            ", but accepts {2}"
-                            .format(transform.transform_name, pipeline_args, input_arguments)
-                        )
-                    for argument, input_arg in zip(pipeline_args, input_arguments):
-                        input_arg.value = argument
-
-                actions = transform.chain(methods)
-
-                # if it outputs anything, store these as pipeline_args in case
-                # the next stage is expecting them
-                output_arguments = [t for t in transform.outputs if t.data_type == 'argument']
-                if output_arguments:
-                    # this check is just to ensure output arguments are
-                    # explicitly documented in pipeline.json
-                    pipeline_args = list(chain.from_iterable([a for a in actions if a]))
-
-                if not pipeline_is_ephemeral:
-                    named_stages[stage_index]['sha1'] = transform.compute_hash()
-
-                # does this stage output a metric?
-                if set(config.get('metrics', [])) & set(named_stages[stage_index]['outputs']) \
-                    or not os.path.exists(path_to_file(config['repo_path'], 'README.md')):
-                    metrics_updated = True
-
-                del config['repo_path']
-
-                config_file.seek(0)
-                config_file.write(
-                    json.dumps(
-                        config,
-                        sort_keys=True,
-                        indent=4,
-                        ensure_ascii=False
+                stages_to_run.append(stage_index)
+
+        # fetch the remote blobs the stages need all at once, rather than
+        # one by one as each stage starts
+        download_missing(
+            chain.from_iterable(
+                transforms[index].inputs + transforms[index].files.values()
+                for index in stages_to_run
+            ),
+            workers=config.get('download_workers', 4)
+        )
+
+        if use_build_cache and not pipeline_is_ephemeral:
+            build_cache = BuildCache.for_repo(repo_path, config)
+        else:
+            build_cache = None
+
+        def start_stage(stage_index):
+            run['stages'][stage_index]['status'] = 'running'
+            transform = transforms[stage_index]
+            transform.prepare_data()
+            build_key = None
+            if not pipeline_is_ephemeral:
+                build_key = transform.compute_build_key(hash_cache)
+                build_keys[stage_index] = build_key
+            if build_cache:
+                if build_key and build_cache.restore(build_key, transform.outputs):
+                    logging.info(
+                        "Restored stage {0} from the build cache"
+                        .format(stage_index + 1)
+                    )
+                    return [], state['pipeline_args']
+
+            logging.info("Starting stage {0}".format(stage_index + 1))
+            transform = load_transform(
+                config,
+                named_stages[stage_index],
+                pipeline_is_ephemeral
+            )
+            transforms[stage_index] = transform
+            unlink_shared_outputs(transform.outputs)
+            transform.checkpoint_key = transform.compute_checkpoint_key(build_key)
+            transform.resume = resume
+            try:
+                result = run_stage(
+                    transform,
+                    named_stages[stage_index],
+                    state['pipeline_args']
+                )
+            finally:
+                transform.close()
+
+            if build_cache and build_key:
+                build_cache.store(build_key, transform.outputs)
+
+            return result
+
+        def start_traced_stage(stage_index):
+            with span(
+                'stage {0}'.format(stage_index + 1),
+                'stage',
+                transform=transforms[stage_index].transform_name
+            ):
+                return start_stage(stage_index)
+
+        def finish_stage(stage_index, result):
+            # called on this thread, one stage at a time, so pipeline.json
+            # is never written concurrently
+            actions, state['pipeline_args'] = result
+            metrics = transforms[stage_index].metrics
+            if metrics:
+                run['stages'][stage_index].update(metrics, status='ran')
+                logging.info(
+                    "Completed stage {0} in {1:.2f}s ({2:.2f}s CPU, peak RSS {3:.0f}MB)"
+                    .format(
+                        stage_index + 1,
+                        metrics['wall_time'],
+                        metrics['cpu_time'],
+                        metrics['peak_rss'] / float(1 << 20)
                     )
                 )
+            else:
+                run['stages'][stage_index]['status'] = 'restored'
+                logging.info("Completed stage {0}".format(stage_index + 1))
+
+            if not pipeline_is_ephemeral:
+                named_stages[stage_index]['sha1'] = transforms[stage_index].compute_hash(hash_cache)
+                if build_keys[stage_index]:
+                    named_stages[stage_index]['build_key'] = build_keys[stage_index]
+                hash_cache.save()
+
+            # does this stage output a metric?
+            if set(config.get('metrics', [])) & set(named_stages[stage_index]['outputs']) \
+                or not os.path.exists(path_to_file(config['repo_path'], 'README.md')):
+                state['metrics_updated'] = True
+
+            # stages may be loading on other threads, so leave repo_path in
+            # the config they share
+            config_file.seek(0)
+            config_file.write(
+                json.dumps(
+                    {k: v for k, v in config.iteritems() if k != 'repo_path'},
+                    sort_keys=True,
+                    indent=4,
+                    ensure_ascii=False
+                )
+            )
+            config_file.truncate()
+            config_file.flush()
+
+        scheduler = StageScheduler(stage_dependencies(named_stages, config), jobs)
+        started = time.time()
+        try:
+            scheduler.run(stages_to_run, start_traced_stage, finish_stage)
+        except Exception:
+            run['status'] = 'failed'
+            for stage in run['stages']:
+                if stage['status'] == 'running':
+                    stage['status'] = 'failed'
+            raise
+        else:
+            run['status'] = 'completed'
+        finally:
+            run['wall_time'] = time.time() - started
+            RunLog.for_repo(repo_path).append(run)
 
-                config['repo_path'] = repo_path
+        if build_cache:
+            build_cache.gc()
 
         if False in cached_stages or force_render_metrics:
             # a better way would be store the hash of the pipeline.json
@@ -105,32 +200,159 @@ def execute_pipeline(repo_path, pipeline_name, pipeline_args=[], cache_stages=Tr
             render_metrics(config, transforms, pipeline_name)
 
 
+def select_pipeline(config, pipeline_name):
+    """
+    Returns the name, stages and whether the named pipeline is ephemeral
+    """
+    if len(config['pipelines']) == 1:
+        pipeline_name = config['pipelines'].keys()[0]
+
+    named_stages = config['pipelines'].get(pipeline_name, None)
+
+    if not named_stages:
+        raise ValueError(
+            "Pipeline.json does not contain a stage named '{0}'"
+            .format(pipeline_name)
+        )
+
+    return pipeline_name, named_stages['stages'], named_stages.get('ephemeral', False)
+
+
+def build_transforms(config, named_stages, pipeline_is_ephemeral):
+    return [load_transform(config, stage, pipeline_is_ephemeral) for stage in named_stages]
+
+
+def load_transform(config, stage, pipeline_is_ephemeral):
+    """
+    Import the module of the stage's transform and create it
+    """
+    module_name, class_name = TRANSFORMS[config['transforms'][stage['transform']]['transform_type']].rsplit('.',1)
+    module = __import__(module_name, fromlist=[class_name])
+    transform_cls = getattr(module, class_name)
+
+    return transform_cls(stage, config, pipeline_is_ephemeral)
+
+
+def describe_stages(config, named_stages, pipeline_is_ephemeral):
+    """
+    A plain PipelineStage for each stage: enough to hash and draw the stages
+    without importing the modules of their transforms, which load_transform
+    does for the stages that run
+    """
+    stages = []
+    for stage in named_stages:
+        transform_type = config['transforms'][stage['transform']]['transform_type']
+        if transform_type not in TRANSFORMS:
+            raise ValueError(
+                "Unknown transform type {0} for {1}"
+                .format(transform_type, stage['transform'])
+            )
+        stages.append(PipelineStage(stage, config, pipeline_is_ephemeral))
+
+    return stages
+
+
+def pack_pipeline_args(transform, pipeline_args):
+    """
+    Several values passed on the command line to a first stage that takes
+    a single argument, such as urls to predict, are passed to it as one list
+    """
+    input_arguments = [t for t in transform.inputs if t.data_type == 'argument']
+    if len(input_arguments) == 1 and len(pipeline_args) > 1:
+        return [list(pipeline_args)]
+
+    return pipeline_args
+
+
+def run_stage(transform, stage, pipeline_args):
+    """
+    Call the stage's actions on its transform, passing in any in-memory
+    pipeline_args.  Returns the results of the actions and the
+    pipeline_args for the next stage.
+    """
+    methods = stage.get('actions', [])
+
+    # if the transform is expecting any in-memory arguments passed
+    # to it, make sure they are passed
+    input_arguments = [t for t in transform.inputs if t.data_type == 'argument']
+    if pipeline_args and input_arguments:
+        if len(pipeline_args) != len(input_arguments):
+            raise ValueError(
+                "Argument mismatch: {0} passed arguments {1}"
+                ", but accepts {2}"
+                .format(transform.transform_name, pipeline_args, input_arguments)
+            )
+        for argument, input_arg in zip(pipeline_args, input_arguments):
+            input_arg.value = argument
+
+    actions = transform.chain(methods)
+
+    # if it outputs anything, store these as pipeline_args in case
+    # the next stage is expecting them
+    output_arguments = [t for t in transform.outputs if t.data_type == 'argument']
+    if output_arguments:
+        # this check is just to ensure output arguments are
+        # explicitly documented in pipeline.json
+        pipeline_args = list(chain.from_iterable([a for a in actions if a]))
+
+    return actions, pipeline_args
+
+
 def init_env(repo_path):
     cachedir = os.path.join(repo_path, 'cache')
     if not os.path.exists(cachedir):
         os.makedirs(cachedir)
 
 
-def detect_changes(transforms, stage_configs):
+def detect_changes(transforms, stage_configs, hash_cache=None, upstream=None):
     """
-    Check preceeding stages have not changed AND files match hashes, including parameter files
+    A stage is cached when its files match the hash stored after its last run,
+    including parameter files, and no stage upstream of it in the data flow
+    is going to rerun.  upstream gives the indexes of those stages, and
+    defaults to every preceeding stage.
+
+    File hashes are looked up in hash_cache when given, so unchanged blobs
+    are not re-hashed.  Returns whether each stage is cached, and why.
     """
-    cached_stages = [False for transform in transforms]
-    for index, (transform, stage_config) in enumerate(zip(transforms, stage_configs)):
+    if upstream is None:
+        upstream = [set(xrange(index)) for index in xrange(len(transforms))]
 
+    cached_stages = []
+    reasons = []
+    for index, (transform, stage_config) in enumerate(zip(transforms, stage_configs)):
+        rerun_upstream = sorted(i + 1 for i in upstream[index] if not cached_stages[i])
         stage_hash = stage_config.get('sha1', None)
-        if not stage_hash:
-            break
+
+        is_cached = False
+        if rerun_upstream:
+            reason = "upstream stages {0} will rerun".format(rerun_upstream)
+        elif not stage_hash:
+            reason = "no hash recorded from a previous run"
+        elif not transform.blob_files_exist():
+            reason = "some blob files do not exist"
+        elif stage_hash != transform.compute_hash(hash_cache):
+            reason = "inputs, files or outputs changed since the last run"
+        elif stage_config.get('build_key', None) and \
+                stage_config['build_key'] != transform.compute_build_key(hash_cache):
+            reason = "transform parameters or actions changed since the last run"
         else:
-            if not transform.blob_files_exist():
-                break
-            current_stage_hash = transform.compute_hash()
-            if stage_hash != current_stage_hash:
-                break
+            is_cached = True
+            reason = "inputs, files and outputs are unchanged"
 
-        cached_stages[index] = True
+        cached_stages.append(is_cached)
+        reasons.append(reason)
 
-    return cached_stages
+    return cached_stages, reasons
+
+
+def explain_changes(transforms, cached_stages, reasons):
+    for index, (transform, is_cached, reason) in enumerate(zip(transforms, cached_stages, reasons)):
+        print "stage {0} ({1}): {2}, {3}".format(
+            index + 1,
+            transform.transform_name,
+            "skipped" if is_cached else "runs",
+            reason
+        )
 
 
 def render_metrics(config, transforms, pipeline_name):
@@ -161,6 +383,11 @@ def render_metrics(config, transforms, pipeline_name):
         datum = Data(metric_name, config, config['data'][metric_name])
         input_files.append(datum.filename)
 
+    if config.get('performance_table', False):
+        last_run = RunLog.for_repo(config['repo_path']).last_run(pipeline_name)
+        if last_run:
+            input_files.append(render_performance(config, pipeline_name, last_run))
+
     with open(output_file, 'w') as outfile:
         for i, fname in enumerate(input_files):
             with open(fname) as infile:
@@ -168,3 +395,13 @@ def render_metrics(config, transforms, pipeline_name):
                     outfile.write("\n\n# Pipeline performance metrics\n")
                 outfile.write("\n\n{0}\n".format(infile.read()))
 
+
+def collect_garbage(repo_path, max_size=None):
+    """
+    Trim the build cache of the repo to its size cap, or to max_size bytes
+    """
+    with open(path_to_file(repo_path, 'pipeline.json'), 'r') as config_file:
+        config = json.loads(config_file.read(), encoding='utf-8')
+
+    build_cache = BuildCache.for_repo(repo_path, config)
+    return build_cache.gc(max_size)
@@ -0,0 +1,224 @@
+import sys
+import time
+import Queue
+import logging
+import threading
+
+import numpy as np
+
+from tracing import span
+
+
+# sentinel passed down the queues once the source is exhausted
+_DONE = object()
+
+
+class StageStats(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.waiting = 0.0
+
+    def report(self):
+        rate = self.items / self.busy if self.busy else 0.0
+        return (
+            "{0}: {1} items, {2:.2f}s busy ({3:.2f} items/s), "
+            "{4:.2f}s waiting".format(
+                self.name,
+                self.items,
+                self.busy,
+                rate,
+                self.waiting
+            )
+        )
+
+
+class StagedPipeline(object):
+    """
+    Push a stream of items through a sequence of named functions, each
+    running on its own thread and connected by bounded queues, so that
+    while one item is in a later stage the next is already being prepared.
+
+    Items leave the pipeline in the order they entered it.  A stage may
+    return None to drop an item.  queue_depths bounds how many items may
+    wait in front of each stage, either as one int for every stage or as a
+    dict keyed by stage name.
+    """
+
+    def __init__(self, stages, queue_depths=None, default_depth=2):
+        self.stages = stages
+        if isinstance(queue_depths, dict):
+            self.depths = [queue_depths.get(name, default_depth) for name, func in stages]
+        else:
+            self.depths = [queue_depths or default_depth] * len(stages)
+        self._queues = [Queue.Queue(maxsize=depth) for depth in self.depths]
+        self.source_stats = StageStats('source')
+        self.stats = [StageStats(name) for name, func in stages]
+        self._failed = threading.Event()
+        self._exc_info = None
+
+    def queue_depth(self, name):
+        """
+        The number of items that may wait in front of the named stage
+        """
+        names = [stage_name for stage_name, func in self.stages]
+        return self.depths[names.index(name)]
+
+    def run(self, source):
+        """
+        Consume the source iterable and block until every item has been
+        through all stages, re-raising the first exception from any stage
+        """
+        threads = [
+            threading.Thread(target=self._feed, args=(source,), name='source')
+        ] + [
+            threading.Thread(target=self._work, args=(index,), name=name)
+            for index, (name, func) in enumerate(self.stages)
+        ]
+        start = time.time()
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for thread in threads:
+                # joined with a timeout, as otherwise Ctrl-C is not handled
+                # until the thread finishes
+                while thread.is_alive():
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            # the threads are daemons, so rather than wait for them to
+            # finish their items just tell them to stop
+            self.stop()
+            raise
+        elapsed = time.time() - start
+
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+        self.log_report(elapsed)
+
+    def log_report(self, elapsed):
+        logging.info("Staged pipeline completed in {0:.2f}s".format(elapsed))
+        for stats in [self.source_stats] + self.stats:
+            logging.info(stats.report())
+
+    def stop(self):
+        """
+        Have every stage stop at its next item, without passing on what is
+        left in the queues
+        """
+        self._failed.set()
+
+    def _fail(self):
+        if not self._failed.is_set():
+            self._exc_info = sys.exc_info()
+            self.stop()
+
+    def _put(self, queue, item, stats):
+        start = time.time()
+        while not self._failed.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+            except Queue.Full:
+                continue
+            else:
+                break
+        stats.waiting += time.time() - start
+
+    def _get(self, queue, stats):
+        start = time.time()
+        while not self._failed.is_set():
+            try:
+                item = queue.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            else:
+                stats.waiting += time.time() - start
+                return item
+
+        return _DONE
+
+    def _feed(self, source):
+        stats = self.source_stats
+        try:
+            iterator = iter(source)
+            while not self._failed.is_set():
+                start = time.time()
+                try:
+                    with span('source', 'prefetch'):
+                        item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    stats.busy += time.time() - start
+                stats.items += 1
+                self._put(self._queues[0], item, stats)
+        except Exception:
+            self._fail()
+        finally:
+            self._put(self._queues[0], _DONE, stats)
+
+    def _work(self, index):
+        name, func = self.stages[index]
+        stats = self.stats[index]
+        is_last = index == len(self.stages) - 1
+        try:
+            while True:
+                # time spent waiting here means the stages before are behind
+                with span('{0}.wait'.format(name), 'prefetch'):
+                    item = self._get(self._queues[index], stats)
+                if item is _DONE:
+                    break
+
+                start = time.time()
+                with span(name, 'prefetch'):
+                    result = func(item)
+                stats.busy += time.time() - start
+                stats.items += 1
+
+                if result is not None and not is_last:
+                    self._put(self._queues[index + 1], result, stats)
+        except Exception:
+            self._fail()
+        finally:
+            if not is_last:
+                self._put(self._queues[index + 1], _DONE, stats)
+
+
+class BufferPool(object):
+    """
+    A fixed set of preallocated arrays handed out and returned by the stages
+    of a pipeline, so each batch does not allocate a fresh array
+    """
+
+    def __init__(self, shape, dtype, count):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.count = count
+        self._buffers = [np.zeros(shape, dtype=dtype) for index in xrange(count)]
+        self._free = Queue.Queue()
+        self.reset()
+
+    def fits(self, shape, dtype, count):
+        """
+        Whether the pool has at least count buffers of shape and dtype
+        """
+        return self.shape == tuple(shape) and self.dtype == np.dtype(dtype) \
+            and self.count >= count
+
+    def reset(self):
+        """
+        Return every buffer to the pool, including any not released by a
+        run that failed part way through
+        """
+        self._free = Queue.Queue()
+        for buf in self._buffers:
+            self._free.put(buf)
+
+    def acquire(self):
+        return self._free.get()
+
+    def release(self, buf):
+        self._free.put(buf)
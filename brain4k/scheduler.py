@@ -0,0 +1,135 @@
+import sys
+import Queue
+import threading
+
+
+def _data_access(named_stages, config):
+    """
+    The names of the data each stage reads and writes
+    """
+    reads = []
+    writes = []
+    for stage in named_stages:
+        files = config['transforms'][stage['transform']].get('files', {})
+        reads.append(set(stage['inputs']) | set(files.values()))
+        writes.append(set(stage['outputs']))
+
+    return reads, writes
+
+
+def stage_dependencies(named_stages, config):
+    """
+    For each stage, the set of indexes of earlier stages it must wait for:
+    any that write data it reads, read data it writes or write the same data
+    """
+    reads, writes = _data_access(named_stages, config)
+
+    dependencies = []
+    for index in xrange(len(named_stages)):
+        dependencies.append(set(
+            earlier for earlier in xrange(index)
+            if writes[earlier] & reads[index]
+            or reads[earlier] & writes[index]
+            or writes[earlier] & writes[index]
+        ))
+
+    return dependencies
+
+
+def upstream_stages(named_stages, config):
+    """
+    For each stage, the set of indexes of earlier stages whose rerunning
+    would change its data: any that write data it reads or that it writes
+    """
+    reads, writes = _data_access(named_stages, config)
+
+    upstream = []
+    for index in xrange(len(named_stages)):
+        upstream.append(set(
+            earlier for earlier in xrange(index)
+            if writes[earlier] & (reads[index] | writes[index])
+        ))
+
+    return upstream
+
+
+class StageScheduler(object):
+    """
+    Run pipeline stages on up to jobs worker threads, starting each stage as
+    soon as every stage it depends on has finished.  Ready stages start in
+    pipeline order, so with one job the stages run exactly as listed.
+    """
+
+    def __init__(self, dependencies, jobs=1):
+        if jobs < 1:
+            raise ValueError("At least one job is needed to run a pipeline")
+
+        self.dependencies = dependencies
+        self.jobs = jobs
+
+    def run(self, stage_indexes, run_stage, finish_stage):
+        """
+        Calls run_stage(index) on a worker thread for each of stage_indexes,
+        then finish_stage(index, result) on the calling thread as each one
+        completes.  Stages not in stage_indexes are treated as already done.
+        If a stage fails no more are started, and once the running stages
+        have finished the first exception is re-raised.
+        """
+        pending = sorted(stage_indexes)
+        done = set(xrange(len(self.dependencies))) - set(pending)
+        running = set()
+        finished = Queue.Queue()
+        exc_info = None
+
+        while pending or running:
+            if not exc_info:
+                ready = [i for i in pending if self.dependencies[i] <= done]
+                for index in ready[:self.jobs - len(running)]:
+                    pending.remove(index)
+                    running.add(index)
+                    self._start(index, run_stage, finished)
+
+            if not running:
+                break
+
+            index, result, error = self._wait(finished)
+            running.remove(index)
+            if error:
+                exc_info = exc_info or error
+                continue
+
+            try:
+                finish_stage(index, result)
+            except Exception:
+                exc_info = exc_info or sys.exc_info()
+            else:
+                done.add(index)
+
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _wait(self, finished):
+        """
+        Wait for the next stage to finish.  Waits without a timeout can not
+        be interrupted in Python 2, so Ctrl-C would be held up until the
+        stage finished; the stage threads are daemons, so an interrupt here
+        exits without them.
+        """
+        while True:
+            try:
+                return finished.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+
+    def _start(self, index, run_stage, finished):
+        def work():
+            try:
+                result = run_stage(index)
+            except Exception:
+                finished.put((index, None, sys.exc_info()))
+            else:
+                finished.put((index, result, None))
+
+        thread = threading.Thread(target=work, name='stage {0}'.format(index + 1))
+        thread.daemon = True
+        thread.start()
@@ -0,0 +1,201 @@
+import json
+import time
+import Queue
+import urlparse
+import logging
+import threading
+from itertools import chain
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from data import path_to_file
+from pipeline import select_pipeline, build_transforms, run_stage, init_env
+
+
+class PendingRequest(object):
+
+    def __init__(self, urls):
+        self.urls = urls
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+    def finish(self, results):
+        self.results = results
+        self.done.set()
+
+    def fail(self, error):
+        self.error = error
+        self.done.set()
+
+
+class PredictionServer(object):
+    """
+    Keep the stages of an ephemeral pipeline loaded, and answer predictions
+    for urls.  Requests that arrive within max_wait seconds of each other are
+    batched together, up to max_batch_size urls, and sent through the
+    pipeline in one pass.
+
+    The last stage of the pipeline must return its predictions as a list of
+    dicts, each with the 'url' the prediction was made for.
+    """
+
+    def __init__(self, repo_path, pipeline_name, max_batch_size=32, max_wait=0.02):
+        with open(path_to_file(repo_path, 'pipeline.json'), 'r') as config_file:
+            config = json.loads(config_file.read(), encoding='utf-8')
+        config['repo_path'] = repo_path
+        init_env(repo_path)
+
+        self.pipeline_name, self.named_stages, pipeline_is_ephemeral = \
+            select_pipeline(config, pipeline_name)
+        if not pipeline_is_ephemeral:
+            raise ValueError(
+                "Only ephemeral pipelines can be served, '{0}' is not"
+                .format(self.pipeline_name)
+            )
+        self.transforms = build_transforms(config, self.named_stages, True)
+
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._requests = Queue.Queue()
+        self._batcher = threading.Thread(target=self._batch_loop)
+        self._batcher.daemon = True
+        self._batcher.start()
+
+    def predict(self, urls):
+        """
+        Returns a prediction for each url, or None for urls that could not
+        be processed.  Blocks until the batch containing the urls has run.
+        """
+        request = PendingRequest(urls)
+        self._requests.put(request)
+        request.done.wait()
+        if request.error:
+            raise request.error
+
+        return request.results
+
+    def close(self):
+        for transform in self.transforms:
+            transform.close()
+
+    def _next_batch(self):
+        batch = [self._requests.get()]
+        url_count = len(batch[0].urls)
+        deadline = time.time() + self.max_wait
+        while url_count < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=timeout)
+            except Queue.Empty:
+                break
+            batch.append(request)
+            url_count += len(request.urls)
+
+        return batch
+
+    def _batch_loop(self):
+        while True:
+            batch = self._next_batch()
+            urls = list(chain.from_iterable(request.urls for request in batch))
+            logging.debug(
+                "Predicting {0} urls for {1} requests"
+                .format(len(urls), len(batch))
+            )
+            try:
+                predictions = self._run(urls)
+            except Exception as e:
+                logging.exception("Prediction failed: {0}".format(e))
+                for request in batch:
+                    request.fail(e)
+            else:
+                by_url = {}
+                for prediction in predictions:
+                    by_url.setdefault(prediction['url'], prediction)
+                for request in batch:
+                    request.finish([by_url.get(url, None) for url in request.urls])
+
+    def _run(self, urls):
+        pipeline_args = [urls]
+        actions = []
+        for transform, stage in zip(self.transforms, self.named_stages):
+            actions, pipeline_args = run_stage(transform, stage, pipeline_args)
+
+        return list(chain.from_iterable([a for a in actions if a]))
+
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /predict?url=...&url=...
+    POST /predict with a json body of {"urls": [...]}
+    """
+
+    def do_GET(self):
+        parsed = urlparse.urlparse(self.path)
+        if parsed.path != '/predict':
+            return self._respond(404, {'error': 'not found'})
+
+        urls = urlparse.parse_qs(parsed.query).get('url', [])
+        self._predict(urls)
+
+    def do_POST(self):
+        if urlparse.urlparse(self.path).path != '/predict':
+            return self._respond(404, {'error': 'not found'})
+
+        length = int(self.headers.getheader('content-length', 0))
+        try:
+            urls = json.loads(self.rfile.read(length))['urls']
+        except (ValueError, KeyError, TypeError):
+            return self._respond(400, {'error': 'expected a json body of {"urls": [...]}'})
+        self._predict(urls)
+
+    def _predict(self, urls):
+        if not urls:
+            return self._respond(400, {'error': 'no urls given'})
+
+        try:
+            predictions = self.server.prediction_server.predict(urls)
+        except Exception as e:
+            return self._respond(500, {'error': str(e)})
+        self._respond(200, {'predictions': predictions})
+
+    def _respond(self, status, body):
+        response = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+def serve(repo_path, pipeline_name, host='127.0.0.1', port=8000, max_batch_size=32, max_wait=0.02):
+    prediction_server = PredictionServer(
+        repo_path,
+        pipeline_name,
+        max_batch_size=max_batch_size,
+        max_wait=max_wait
+    )
+    httpd = ThreadedHTTPServer((host, port), PredictionRequestHandler)
+    httpd.prediction_server = prediction_server
+
+    logging.info(
+        "Serving the {0} pipeline on http://{1}:{2}/predict"
+        .format(prediction_server.pipeline_name, host, port)
+    )
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        prediction_server.close()
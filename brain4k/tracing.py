@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import threading
+from functools import wraps
+
+
+# the Tracer recording spans, or None while tracing is off, which is all
+# span and traced check
+_tracer = None
+
+
+class Tracer(object):
+    """
+    Collects timed spans as Chrome trace events, which can be opened in
+    chrome://tracing or Perfetto to see what each thread and process was
+    doing over the course of a run
+    """
+
+    def __init__(self):
+        self.origin = time.time()
+        self.events = []
+        self._named_threads = set()
+        self._lock = threading.Lock()
+
+    def add(self, name, category, start, stop, args):
+        thread = threading.current_thread()
+        pid = os.getpid()
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': (start - self.origin) * 1e6,
+            'dur': (stop - start) * 1e6,
+            'pid': pid,
+            'tid': thread.ident,
+        }
+        if args:
+            event['args'] = args
+
+        with self._lock:
+            if (pid, thread.ident) not in self._named_threads:
+                self._named_threads.add((pid, thread.ident))
+                self.events.append({
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': pid,
+                    'tid': thread.ident,
+                    'args': {'name': thread.name}
+                })
+            self.events.append(event)
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+
+class Span(object):
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.add(self.name, self.category, self.start, time.time(), self.args)
+
+
+class NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(name, category='brain4k', **args):
+    """
+    A context manager timing its block as a span, when tracing is on
+    """
+    if _tracer is None:
+        return NULL_SPAN
+    return Span(_tracer, name, category, args)
+
+
+def traced(name, category='brain4k'):
+    """
+    Decorate a function to time each call as a span, when tracing is on
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            with Span(_tracer, name, category, None):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def enable():
+    global _tracer
+    _tracer = Tracer()
+
+
+def disable():
+    global _tracer
+    _tracer = None
+
+
+def save(filename):
+    if _tracer is not None:
+        _tracer.save(filename)
+
+
+def forget_parent_events():
+    """
+    In a forked worker process, drop the events copied from the parent, and
+    replace the lock, which another of the parent's threads may have held
+    """
+    if _tracer is not None:
+        _tracer._lock = threading.Lock()
+        _tracer.events = []
+        _tracer._named_threads = set()
+
+
+def take_events():
+    """
+    Remove and return the events recorded so far, so a worker process can
+    pass them back to be added to its parent's trace
+    """
+    if _tracer is None:
+        return []
+
+    with _tracer._lock:
+        events = _tracer.events
+        _tracer.events = []
+        _tracer._named_threads = set()
+
+    return events
+
+
+def add_events(events):
+    if _tracer is not None and events:
+        with _tracer._lock:
+            _tracer.events.extend(events)
@@ -1,9 +1,14 @@
 import os
 import logging
+from copy import deepcopy
 
 
 class PipelineStage(object):
 
+    # set by transforms whose actions skip the rows already committed to
+    # their hdf5 outputs' journals, so a failed run can be resumed
+    resumable_outputs = False
+
     def __init__(self, stage_config, config, is_ephemeral):
         from brain4k.data import Data
 
@@ -12,10 +17,39 @@ class PipelineStage(object):
         self.inputs = [Data(name, config, config['data'][name]) for name in stage_config['inputs']]
         self.outputs = [Data(name, config, config['data'][name]) for name in stage_config['outputs']]
         self.transform_name = stage_config['transform']
-        self.parameters = config['transforms'][self.transform_name].get('parameters', {})
+        self.transform_type = config['transforms'][self.transform_name]['transform_type']
+        # a copy, so transforms adjusting their parameters while running do
+        # not alter pipeline.json
+        self.parameters = deepcopy(config['transforms'][self.transform_name].get('parameters', {}))
         files = config['transforms'][self.transform_name].get('files', {})
         self.files = {name: Data(data_name, config, config['data'][data_name]) for name, data_name in files.iteritems()}
 
+        # set by the pipeline: the stage's checkpoint key, which journals
+        # must match to be resumed, and whether to resume them
+        self.checkpoint_key = None
+        self.resume = False
+        # set by actions that keep rows written somewhere besides the
+        # outputs, such as shards, for a failed run to be resumed from
+        self.partial_outputs_kept = False
+
+        # chunked actions count the rows they process here, and chain
+        # records what the stage's actions used in metrics
+        self.rows_processed = 0
+        self.metrics = None
+
+    def prepare_data(self):
+        """
+        Download any remote inputs and files, and create the directories
+        the outputs are written to, once the stage is going to run
+        """
+        for datum in self.inputs + self.files.values() + self.outputs:
+            datum.prepare()
+
+        hdf5_options = self.parameters.get('hdf5_options', {})
+        for datum in self.outputs:
+            if datum.data_type == 'hdf5':
+                datum.io.options = hdf5_options
+
     def chain(self, actions):
         for action in actions:
             if not hasattr(self, action):
@@ -23,39 +57,188 @@ class PipelineStage(object):
                     "{0} does not support action {1}".format(self.name, action)
                 )
 
+        from brain4k.instrument import Measurement, blob_states, blob_io
+        from brain4k.tracing import span
+
+        with Measurement() as preparation:
+            self.prepare_data()
+
+        journals = self._open_journals()
+        data = self.inputs + self.files.values() + self.outputs
+        states = blob_states(data)
+        measurements = []
         try:
-            results = [getattr(self, action)() for action in actions]
+            results = []
+            for action in actions:
+                rows_before = self.rows_processed
+                with Measurement() as measurement, \
+                        span('{0}.{1}'.format(self.transform_name, action), 'stage'):
+                    results.append(getattr(self, action)())
+                measurements.append((action, measurement, self.rows_processed - rows_before))
         except Exception as e:
             logging.exception(
                 "Encountered unhandled exception during when"
                 " calling {0} on {1}: {2}"
                 .format(action, self.name, e)
             )
+            if self.partial_outputs_kept or any(journal.has_commits for journal in journals):
+                logging.error(
+                    "Keeping the rows written so far, run again with --resume"
+                    " to carry on from them"
+                )
+                raise
+
             logging.exception(
                 "Deleting all output blobs for stage"
             )
+            for journal in journals:
+                journal.remove()
             for datum in self.outputs:
-                os.remove(datum.filename)
+                if datum.data_type != 'argument' and os.path.exists(datum.filename):
+                    os.remove(datum.filename)
             raise
         else:
+            for journal in journals:
+                journal.remove()
+            self.metrics = self._collect_metrics(
+                preparation,
+                measurements,
+                blob_io(
+                    self.inputs + self.files.values(),
+                    self.outputs,
+                    states,
+                    blob_states(data)
+                )
+            )
             return results
 
-    def compute_hash(self):
-        from brain4k.data_interfaces import compute_json_hash, compute_file_hash
+    def _collect_metrics(self, preparation, measurements, blobs):
+        """
+        Totals for the stage from the measurements of preparing its data and
+        of each of its actions
+        """
+        all_measurements = [preparation] + [m for action, m, rows in measurements]
+        metrics = {
+            'transform': self.transform_name,
+            'wall_time': sum(m.wall_time for m in all_measurements),
+            'cpu_time': sum(m.cpu_time for m in all_measurements),
+            'peak_rss': max(m.peak_rss for m in all_measurements),
+            'blobs': blobs,
+            'actions': []
+        }
+        for key in preparation.io:
+            metrics[key] = sum(m.io[key] for m in all_measurements)
+
+        for action, measurement, rows in measurements:
+            action_metrics = measurement.as_dict()
+            action_metrics['action'] = action
+            if rows:
+                action_metrics['rows'] = rows
+                action_metrics['rows_per_second'] = rows / max(measurement.wall_time, 1e-6)
+            metrics['actions'].append(action_metrics)
+
+        if self.rows_processed:
+            chunked_time = sum(m.wall_time for action, m, rows in measurements if rows)
+            metrics['rows'] = self.rows_processed
+            metrics['rows_per_second'] = self.rows_processed / max(chunked_time, 1e-6)
+
+        return metrics
+
+    def _open_journals(self):
+        """
+        Journal the rows written to hdf5 outputs, so a failed run can be
+        resumed.  Stages without a checkpoint key, or whose transform does
+        not resume its outputs, are not journaled.
+        """
+        from brain4k.checkpoint import CheckpointJournal
+
+        if not self.checkpoint_key or not self.resumable_outputs:
+            return []
+
+        journals = []
+        for datum in self.outputs:
+            if datum.data_type == 'hdf5':
+                datum.io.journal = CheckpointJournal.for_output(
+                    datum.filename,
+                    self.checkpoint_key,
+                    self.resume
+                )
+                journals.append(datum.io.journal)
+
+        return journals
+
+    def compute_hash(self, hash_cache=None):
+        from brain4k.data_interfaces import compute_json_hash, compute_file_hashes
+
+        if hash_cache:
+            compute_file_hashes = hash_cache.compute_file_hashes
 
-        stage_hashes = []
         varying_data = self.config.get('accept_variance_in', [])
         data = self.inputs + self.files.values() + self.outputs
 
         non_varying_data = set([datum.filename for datum in data if datum.name not in varying_data])
-        for filename in non_varying_data:
-            filehash = compute_file_hash(filename)
-            stage_hashes.append(filehash)
+        stage_hashes = compute_file_hashes(non_varying_data).values()
 
         stage_hash = compute_json_hash({'stage_hashes': sorted(stage_hashes)})
 
         return stage_hash
 
+    def compute_build_key(self, hash_cache=None):
+        """
+        Identifies the outputs this stage will produce: a hash of its input
+        and file hashes, transform type, parameters and actions, leaving out
+        the transform's PERFORMANCE_PARAMETERS.  Returns None when the stage
+        takes in-memory arguments, as those can not be hashed.
+        """
+        from brain4k.data_interfaces import compute_json_hash, compute_file_hashes
+
+        if hash_cache:
+            compute_file_hashes = hash_cache.compute_file_hashes
+
+        if any(datum.data_type == 'argument' for datum in self.inputs + self.outputs):
+            return None
+
+        data = self.inputs + self.files.values()
+        filehashes = compute_file_hashes(set(datum.filename for datum in data))
+
+        return compute_json_hash({
+            'inputs': [filehashes[datum.filename] for datum in self.inputs],
+            'files': {name: filehashes[datum.filename] for name, datum in self.files.iteritems()},
+            'outputs': [datum.name for datum in self.outputs],
+            'transform_type': self.transform_type,
+            'parameters': {
+                name: value for name, value in self.parameters.iteritems()
+                if name not in PERFORMANCE_PARAMETERS.get(self.transform_type, ())
+            },
+            'actions': self.config.get('actions', [])
+        })
+
+    def compute_checkpoint_key(self, build_key):
+        """
+        Identifies the run a checkpoint journal was written by: the build
+        key along with every parameter, as performance parameters decide how
+        rows are batched and sharded, which a resumed run has to match.
+        None when there is no build key.
+        """
+        from brain4k.data_interfaces import compute_json_hash
+
+        if build_key is None:
+            return None
+
+        return compute_json_hash({
+            'build_key': build_key,
+            'parameters': self.parameters
+        })
+
+    def close(self):
+        """
+        Release anything the transform holds on to between runs of its
+        actions, such as worker threads.  Called once the stage is done
+        with, so a transform kept loaded by the server is only closed when
+        the server stops.
+        """
+        pass
+
     def blob_files_exist(self):
         """
         Before computing the sha1 hash, we might want to check that the
@@ -77,3 +260,26 @@ TRANSFORMS = {
     "com.brain4k.transforms.data_join": "brain4k.transforms.b4k.DataJoin",
     "org.scikit-learn.metrics.confusion_matrix": "brain4k.transforms.sklearn.metrics.ConfusionMatrix",
 }
+
+# for each transform type, the parameters that only change how fast it runs,
+# or how much memory it uses, and never the outputs it produces.  They are
+# left out of the build key, so changing them neither reruns a stage nor
+# misses the build cache.  Kept here rather than on the transforms, so
+# stages can be hashed without importing them.
+PERFORMANCE_PARAMETERS = {
+    # not the fetch timeout or retries, which decide the urls that fail and
+    # so the rows that are dropped
+    "org.berkeleyvision.caffe.bvlc_caffenet": frozenset([
+        'workers',
+        'queue_depths',
+        'batch_size',
+        'batch_size_tuning_repeats',
+        'memory_budget_mb',
+        'fetch_workers',
+    ]),
+    "org.scikit-learn.cross_validation.test_train_split": frozenset(['memory_budget_mb']),
+    # not join_mode, as the two joins are separate implementations
+    "com.brain4k.transforms.data_join": frozenset(['memory_budget_mb']),
+    # none for naive bayes, as training_mode and memory_budget_mb decide the
+    # blocks the model is summed from, which can change it in the last bits
+}
@@ -1,9 +1,12 @@
+import os
 import logging
 import itertools
-from copy import deepcopy
 
+import numpy as np
 import pandas as pd
 
+from brain4k.data_interfaces import HDF5Interface
+from brain4k.tracing import span
 from brain4k.transforms import PipelineStage
 
 
@@ -16,6 +19,7 @@ class DataJoin(PipelineStage):
     """
 
     name = "org.brain4k.transforms.DataJoin"
+    resumable_outputs = True
 
     def join(self):
         if len(self.inputs) != 2:
@@ -32,60 +36,183 @@ class DataJoin(PipelineStage):
             )
         )
 
+        left_output_keys = {k: v for k, v in self.parameters['output_keys'].iteritems() if k in self.parameters['retain_keys']['left']}
+        right_output_keys = {k: v for k, v in self.parameters['output_keys'].iteritems() if k in self.parameters['retain_keys']['right']}
+
+        if self.parameters.get('join_mode', 'memory') == 'streaming':
+            self._streaming_join(left_output_keys, right_output_keys)
+        else:
+            self._memory_join(left_output_keys, right_output_keys)
+
+        logging.info(
+            "Completed join saved as {0}".format(self.outputs[0].filename)
+        )
+
+    def _memory_join(self, left_output_keys, right_output_keys):
         left_index = self.inputs[0].io.read_all([self.parameters['left_on']])
         left_index_flattened = left_index[self.parameters['left_on']].flatten()
-        # create a minimal dataframe for the left part of the join
-        left = pd.DataFrame({self.parameters['left_on']: left_index_flattened})
+        # create a minimal dataframe for the left part of the join, carrying
+        # each row's position, as a left row matching several right rows
+        # appears more than once
+        left = pd.DataFrame({
+            self.parameters['left_on']: left_index_flattened,
+            LEFT_ROW: np.arange(left_index_flattened.shape[0])
+        })
 
         right_keys = set([self.parameters['right_on']]) | set(self.parameters['retain_keys']['right'])
         right = self.inputs[1].io.read_all(usecols=list(right_keys))
 
-        df = pd.merge(
-            left,
-            right,
-            how='left',
-            left_on=self.parameters['left_on'],
-            right_on=self.parameters['right_on']
-        ).dropna()
-
-        h5py_file = self.outputs[0].io.open(mode='w')
-        h5py_left = self.inputs[0].io.open()
+        with span('join.merge', 'join', left_rows=left.shape[0], right_rows=right.shape[0]):
+            df = pd.merge(
+                left,
+                right,
+                how='left',
+                left_on=self.parameters['left_on'],
+                right_on=self.parameters['right_on']
+            ).dropna()
 
-        left_output_keys = {k: v for k, v in self.parameters['output_keys'].iteritems() if k in self.parameters['retain_keys']['left']}
-        right_output_keys = {k: v for k, v in self.parameters['output_keys'].iteritems() if k in self.parameters['retain_keys']['right']}
         for keyset in (left_output_keys, right_output_keys):
             for key in keyset:
                 keyset[key]['shape'][0] = df.shape[0]
 
-        self.outputs[0].io.create_dataset(
-            h5py_file,
+        h5py_file = self.outputs[0].io.open_output(
             self.parameters['output_keys'],
-            deepcopy(left_output_keys).update(right_output_keys)
+            df.shape[0]
         )
+        h5py_left = self.inputs[0].io.open()
+        try:
+            # first copy the left side in chunks, skipping any written by an
+            # earlier run that is being resumed
+            write_chunk_size = 1000
+            for index, chunk in enumerate(grouper(write_chunk_size, df[LEFT_ROW].values)):
+                start_row = index*write_chunk_size
+                if self.outputs[0].io.is_committed(start_row, start_row + len(chunk), left_output_keys.keys()):
+                    continue
+                self.outputs[0].io.write_chunk(
+                    h5py_file,
+                    {k: self.inputs[0].io.read_rows(h5py_left[k], chunk) for k in left_output_keys.keys()},
+                    left_output_keys,
+                    start_row
+                )
+
+            # now copy the right side in from the merged dataframe
+            if not self.outputs[0].io.is_committed(0, df.shape[0], right_output_keys.keys()):
+                self.outputs[0].io.write_chunk(
+                    h5py_file,
+                    # may be better to do this the conversion within the method
+                    {k: df[k].values.astype(right_output_keys[k]['dtype']) for k in right_output_keys.keys()},
+                    right_output_keys
+                )
+        finally:
+            self.inputs[0].io.close(h5py_left)
+            # a failed join's rows are kept to be resumed, so the file must
+            # be closed for the next run to open it
+            self.outputs[0].io.save(h5py_file)
+        self.rows_processed += df.shape[0]
+
+    def _streaming_join(self, left_output_keys, right_output_keys):
+        """
+        Join without holding the right side in memory.
+
+        Only the left join keys are indexed in memory.  The right side is
+        streamed through in chunks, and its matches are spilled to disk in
+        partitions covering consecutive ranges of left rows.  Each partition
+        is then sorted and written out in turn, so the output rows are in the
+        same order as for the in-memory join, while at most one chunk or one
+        partition is held at a time.  Both are sized to fit within
+        memory_budget_mb.
+        """
+        left_on = self.parameters['left_on']
+        right_on = self.parameters['right_on']
+        right_keys = set([right_on]) | set(self.parameters['retain_keys']['right'])
+
+        left_index = self.inputs[0].io.read_all([left_on])[left_on].flatten()
+        left = pd.DataFrame({
+            left_on: left_index,
+            LEFT_ROW: np.arange(left_index.shape[0])
+        })
 
-        # first copy the left side in chunks
-        write_chunk_size = 1000
-        for index, chunk in enumerate(grouper(write_chunk_size, df.index)):
-            self.outputs[0].io.write_chunk(
-                h5py_file,
-                {k: h5py_left[k][list(chunk)] for k in left_output_keys.keys()},
-                left_output_keys,
-                index*write_chunk_size
+        h5py_left = self.inputs[0].io.open()
+        row_bytes = LEFT_ROW_DTYPE.itemsize
+        for key in left_output_keys:
+            row_bytes += h5py_left[key].dtype.itemsize * int(np.prod(h5py_left[key].shape[1:]))
+        for key, parameters in right_output_keys.iteritems():
+            row_bytes += np.dtype(parameters['dtype']).itemsize * int(np.prod(parameters['shape'][1:]))
+        memory_budget = int(self.parameters.get('memory_budget_mb', 512) * (1 << 20))
+        # leave room for the copies pandas and numpy make along the way
+        block_rows = int(max(1, memory_budget / (2 * row_bytes)))
+
+        spill_io = HDF5Interface(self.outputs[0].filename + '.spill')
+        spill = spill_io.open(mode='w')
+        h5py_file = None
+        try:
+            logging.debug("Streaming {0} through the join...".format(self.inputs[1].filename))
+            for chunk in self.inputs[1].io.read_chunk(block_rows, keys=list(right_keys)):
+                with span('join.merge_chunk', 'join', rows=chunk.shape[0]):
+                    matched = pd.merge(
+                        left,
+                        chunk,
+                        how='inner',
+                        left_on=left_on,
+                        right_on=right_on
+                    ).dropna()
+                partitions = matched[LEFT_ROW].values // block_rows
+                with span('join.spill', 'join', rows=matched.shape[0]):
+                    for partition in np.unique(partitions):
+                        rows = matched[partitions == partition]
+                        out = {k: rows[k].values.astype(v['dtype']) for k, v in right_output_keys.iteritems()}
+                        out[LEFT_ROW] = rows[LEFT_ROW].values.astype(LEFT_ROW_DTYPE)
+                        spill_io.append(spill.require_group(str(partition)), out)
+
+            row_count = sum(group[LEFT_ROW].shape[0] for group in spill.values())
+            for keyset in (left_output_keys, right_output_keys):
+                for key in keyset:
+                    keyset[key]['shape'][0] = row_count
+
+            h5py_file = self.outputs[0].io.open_output(
+                self.parameters['output_keys'],
+                row_count
             )
-        self.inputs[0].io.close(h5py_left)
-
-        # now copy the right side in from the merged dataframe
-        self.outputs[0].io.write_chunk(
-            h5py_file,
-            # may be better to do this the conversion within the method
-            {k: df[k].values.astype(right_output_keys[k]['dtype']) for k in right_output_keys.keys()},
-            right_output_keys
-        )
-        self.outputs[0].io.save(h5py_file)
 
-        logging.info(
-            "Completed join saved as {0}".format(self.outputs[0].filename)
-        )
+            start_row = 0
+            for partition in sorted(spill.keys(), key=int):
+                group = spill[partition]
+                partition_rows = group[LEFT_ROW].shape[0]
+                if self.outputs[0].io.is_committed(start_row, start_row + partition_rows, self.parameters['output_keys'].keys()):
+                    # written by an earlier run that is being resumed
+                    start_row += partition_rows
+                    continue
+
+                with span('join.gather_partition', 'join', partition=partition, rows=partition_rows):
+                    # a stable sort keeps multiple matches in right hand order
+                    left_rows = group[LEFT_ROW][()]
+                    order = np.argsort(left_rows, kind='mergesort')
+                    left_rows = left_rows[order]
+
+                    out = {k: self.inputs[0].io.read_rows(h5py_left[k], left_rows) for k in left_output_keys}
+                    out.update({k: group[k][()][order] for k in right_output_keys})
+                self.outputs[0].io.write_chunk(
+                    h5py_file,
+                    out,
+                    self.parameters['output_keys'],
+                    start_row
+                )
+                start_row += left_rows.shape[0]
+
+            self.outputs[0].io.save(h5py_file)
+            self.rows_processed += row_count
+        finally:
+            spill_io.close(spill)
+            os.remove(spill_io.filename)
+            self.inputs[0].io.close(h5py_left)
+            if h5py_file is not None:
+                # saved already, unless the join failed part way
+                self.outputs[0].io.close(h5py_file)
+
+
+# column used to carry each left row's position through the join
+LEFT_ROW = '_left_row'
+LEFT_ROW_DTYPE = np.dtype('int64')
 
 
 def grouper(n, iterable):
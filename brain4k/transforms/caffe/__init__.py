@@ -1,29 +1,47 @@
+import os
+import time
 import logging
+import multiprocessing
 from collections import defaultdict
 
 import numpy as np
 import caffe
 
+from brain4k.checkpoint import CheckpointJournal
+from brain4k.data_interfaces import HDF5Interface
+from brain4k.fetch import ConcurrentFetcher, is_url, fetch_to_file
+from brain4k.prefetch import StagedPipeline, BufferPool
+from brain4k.tracing import span, traced, forget_parent_events, take_events, add_events
 from brain4k.transforms import PipelineStage
 from brain4k.transforms.b4k import grouper
 
 
+# the output dataset mapping each row back to the input row it came from
+INPUT_ROWS = 'input_rows'
+
+
 class BVLCCaffeNet(PipelineStage):
 
     name = "org.berkeleyvision.caffe.bvlc_caffenet"
+    resumable_outputs = True
 
     def predict_for_url(self):
         """
-        has been written to support multiple urls, but in practice
-        command-line only expects 1 url.  This could be re-written to do only
+        The command-line passes a single url, while the prediction server
+        passes a list of urls batched together from concurrent requests
         """
-        urls = [self.inputs[0].value]
-        chunk_size = 10
+        urls = self.inputs[0].value
+        if not isinstance(urls, list):
+            urls = [urls]
+        chunk_size = self._batch_size
+        # urls are sent through the network a batch at a time, so however
+        # many there are one buffer of the batch size is enough
+        self._reuse_input_buffers(1)
         results = defaultdict(list)
 
         for urls_chunk in grouper(chunk_size, urls):
             inputs, processed_urls = self._prepare_image_batch(urls_chunk, chunk_size)
-            unprocessed_urls = set(urls) - set(processed_urls)
+            unprocessed_urls = set(urls_chunk) - set(processed_urls)
             if unprocessed_urls:
                 logging.warning(
                     "some urls: {0} were not fetched successfully"
@@ -34,6 +52,7 @@ class BVLCCaffeNet(PipelineStage):
                 for key, values in out.iteritems():
                     output_shape = [values.shape[0]] + list(self.parameters['output_keys'][key]['shape'][1:])
                     results[key].append(values.reshape(output_shape))
+            self._input_buffers.release(inputs)
 
         for key, values in results.iteritems():
             results[key] = np.concatenate(values)
@@ -42,68 +61,254 @@ class BVLCCaffeNet(PipelineStage):
 
 
     def predict(self):
+        """
+        Extract features for every url of the input csv.  Rows are packed
+        densely, leaving out urls that could not be fetched, and the input
+        row each output row came from is recorded in the input_rows dataset.
+        """
         if len(self.outputs) != 1:
             raise ValueError("{0} expects only one output".format(self.name))
 
+        workers = self.parameters.get('workers', 1)
         for index, input_data in enumerate(self.inputs):
-            h5py_file = self.outputs[index].io.open(mode='w')
-            self.outputs[index].io.create_dataset(
+            output = self.outputs[index]
+            row_count = input_data.io.get_row_count()
+            if workers > 1:
+                self._predict_sharded(input_data, output, row_count, workers)
+            else:
+                h5py_file = output.io.open_output(self._output_keys, row_count, resizable=True)
+                self._predict_rows(input_data, output.io, h5py_file, 0, row_count)
+                output.io.save(h5py_file)
+            self.rows_processed += row_count
+
+    @property
+    def _output_keys(self):
+        output_keys = dict(self.parameters['output_keys'])
+        output_keys[INPUT_ROWS] = {'dtype': 'int64', 'shape': [0]}
+        return output_keys
+
+    def _predict_rows(self, input_data, io, h5py_file, start, stop):
+        """
+        Extract features for rows start to stop of input_data, writing them
+        with io to the resizable datasets of h5py_file one after another,
+        which are then trimmed to the rows written.  When resuming, rows
+        committed to io's journal by an earlier run are kept, and reading
+        carries on from the input row after the last of them, whatever size
+        of chunks the earlier run read.  Returns the number of rows written.
+        """
+        chunk_size = self._batch_size
+        output_keys = self._output_keys
+        # where the next rows are written
+        cursor = {'row': io.committed_rows(output_keys.keys())}
+        if cursor['row']:
+            last_input_row = int(h5py_file[INPUT_ROWS][cursor['row'] - 1])
+        else:
+            last_input_row = -1
+
+        def fetch(item):
+            chunk_count, chunk = item
+            logging.debug("Fetching remote images...")
+            images, processed_urls, positions = self._fetch_images(chunk['url'])
+            if len(processed_urls) == 0:
+                logging.warning(
+                    "No images were successfully fetched from urls: {0}"
+                    .format(chunk['url'])
+                )
+                return None
+            return chunk_count, images, processed_urls, chunk.index.values[positions]
+
+        def preprocess(item):
+            chunk_count, images, processed_urls, input_rows = item
+            inputs = self._preprocess_images(images, chunk_size)
+            return chunk_count, inputs, processed_urls, input_rows
+
+        def forward(item):
+            chunk_count, inputs, processed_urls, input_rows = item
+            out = self._extract_features(inputs, processed_urls, chunk_size)
+            out[INPUT_ROWS] = input_rows
+            self._input_buffers.release(inputs)
+            return chunk_count, out
+
+        def write(item):
+            chunk_count, out = item
+            io.write_chunk(
                 h5py_file,
-                self.parameters['output_keys'],
-                input_data.io.get_row_count()
+                out,
+                output_keys,
+                start_row=cursor['row']
             )
+            cursor['row'] += out[INPUT_ROWS].shape[0]
 
-            chunk_size = 10
+        # initialize the network before the stage threads share it
+        self._net
+        pipeline = StagedPipeline(
+            [
+                ('fetch', fetch),
+                ('preprocess', preprocess),
+                ('forward', forward),
+                ('write', write)
+            ],
+            queue_depths=self.parameters.get('queue_depths', None)
+        )
+        # enough buffers for every batch that can be waiting for, or
+        # going through, the forward pass while the next is preprocessed
+        self._reuse_input_buffers(pipeline.queue_depth('forward') + 2)
+        # rows are written in order, so every row up to the last one
+        # written has been done
+        first_row = max(start, last_input_row + 1)
+        if first_row > start:
+            logging.info(
+                "Carrying on from row {0}, finished up to there by an earlier run"
+                .format(first_row)
+            )
+        if first_row == 0 and stop == input_data.io.get_row_count():
+            chunks = input_data.io.read_chunk(chunk_size=chunk_size)
+        else:
+            chunks = input_data.io.read_chunk(chunk_size=chunk_size, start=first_row, stop=stop)
+        pipeline.run(enumerate(chunks))
 
-            for chunk_count, chunk in enumerate(input_data.io.read_chunk(chunk_size=chunk_size)):
-                inputs, processed_urls = self._prepare_image_batch(chunk['url'], chunk_size)
-                if len(processed_urls) == 0:
-                    logging.warning(
-                        "No images were successfully fetched from urls: {0}"
-                        .format(chunk['url'])
-                    )
-                else:
-                    out = self._extract_features(inputs, processed_urls, chunk_size)
+        io.trim(h5py_file, output_keys.keys(), cursor['row'])
+        logging.info(
+            "Extracted features for {0} of {1} rows, dropping {2} that could"
+            " not be fetched".format(cursor['row'], stop - start, stop - start - cursor['row'])
+        )
 
-                    self.outputs[0].io.write_chunk(
-                        h5py_file,
-                        out,
-                        self.parameters['output_keys'],
-                        start_row=chunk_count*chunk_size
-                    )
+        return cursor['row']
 
-            # TODO: shrink dataset size to remove zeros
-            self.outputs[index].io.save(h5py_file)
+    def _predict_sharded(self, input_data, output, row_count, workers):
+        """
+        Split the rows of input_data into one range per worker process, each
+        loading its own network and writing an uncompressed shard file, then
+        stitch the shards together into output
+        """
+        shard_rows = max(1, -(-row_count // workers))
+        shards = [
+            (
+                self,
+                input_data,
+                start,
+                min(start + shard_rows, row_count),
+                '{0}.shard{1}'.format(output.filename, shard_index)
+            )
+            for shard_index, start in enumerate(xrange(0, row_count, shard_rows))
+        ]
+        # journaled shards are kept if extraction fails, to be resumed
+        keep_shards = bool(self.checkpoint_key)
+
+        logging.info(
+            "Extracting features for {0} rows in {1} shards".format(row_count, len(shards))
+        )
+        pool = multiprocessing.Pool(max(1, len(shards)))
+        try:
+            shard_sizes = []
+            for rows, events in pool.map(_predict_shard, shards):
+                shard_sizes.append(rows)
+                add_events(events)
+            pool.close()
+            keep_shards = False
+
+            h5py_file = output.io.open(mode='w')
+            output.io.create_dataset(
+                h5py_file,
+                self._output_keys,
+                sum(shard_sizes)
+            )
+            offset = 0
+            for (stage, input_data, start, stop, shard_filename), shard_size in zip(shards, shard_sizes):
+                shard = HDF5Interface(shard_filename)
+                h5py_shard = shard.open(mode='r')
+                for key in self._output_keys.keys():
+                    lazy_dataset = shard.lazy(h5py_shard, key)
+                    with span('caffe.stitch_shard', 'caffe', key=key, rows=shard_size):
+                        for block_start, block_stop, rows in lazy_dataset.iter_blocks():
+                            h5py_file[key][offset + block_start:offset + block_stop] = rows
+                shard.close(h5py_shard)
+                offset += shard_size
+
+            output.io.save(h5py_file)
+        finally:
+            pool.terminate()
+            pool.join()
+            if keep_shards:
+                self.partial_outputs_kept = True
+                logging.info(
+                    "Keeping the shards of {0} for --resume".format(output.filename)
+                )
+            else:
+                # including any left by an earlier run with more workers
+                output_dir, output_name = os.path.split(output.filename)
+                for name in os.listdir(output_dir):
+                    if name.startswith(output_name + '.shard'):
+                        os.remove(os.path.join(output_dir, name))
 
     def _prepare_image_batch(self, urls, chunk_size):
         logging.debug("Fetching remote images...")
-        images, processed_urls = self._fetch_images(urls)
+        images, processed_urls, positions = self._fetch_images(urls)
+        inputs = self._preprocess_images(images, chunk_size)
+
+        return inputs, processed_urls
+
+    def _reuse_input_buffers(self, count):
+        """
+        Make sure there are at least count preallocated input batches.  They
+        are allocated on first use and kept, so the server does not
+        allocate them afresh for every request.
+        """
+        shape = self._input_shape(self._batch_size)
+        if not hasattr(self, '_input_buffers') or \
+                not self._input_buffers.fits(shape, np.float32, count):
+            self._input_buffers = BufferPool(shape, np.float32, count)
+        else:
+            self._input_buffers.reset()
+
+    @traced('caffe.preprocess_images', 'caffe')
+    def _preprocess_images(self, images, chunk_size):
         logging.debug("resizing images...")
         resized_images = [caffe.io.resize_image(im, self._net.image_dims) for im in images]
 
-        inputs = np.zeros(
-            (chunk_size, 3, self._net.image_dims[0], self._net.image_dims[1]),
-            dtype=np.float32
-        )
+        inputs = self._input_buffers.acquire()
         logging.debug("preprocessing images...")
         for i, image in enumerate(resized_images):
             inputs[i] = self._net.preprocess(self._net.inputs[0], image)
+        # the buffer is reused, so clear out images from an earlier batch
+        inputs[len(resized_images):] = 0
 
-        return inputs, processed_urls
+        return inputs
+
+    def _input_shape(self, batch_size):
+        return (batch_size, 3, self._net.image_dims[0], self._net.image_dims[1])
 
+    @traced('caffe.fetch_images', 'caffe')
     def _fetch_images(self, urls):
+        """
+        Returns the images that could be fetched, their urls, and their
+        positions in urls
+        """
         images = []
         processed_urls = []
-        for url in urls:
-            try:
-                image = caffe.io.load_image(url)
-            except Exception:
-                pass
-            else:
+        positions = []
+        for position, (url, image) in enumerate(zip(urls, self._fetcher.fetch(urls))):
+            if image is not None:
                 images.append(image)
                 processed_urls.append(url)
+                positions.append(position)
+
+        return images, processed_urls, positions
+
+    def close(self):
+        if hasattr(self, '_image_fetcher'):
+            self._image_fetcher.close()
+            del self._image_fetcher
+
+    @property
+    def _fetcher(self):
+        if not hasattr(self, '_image_fetcher'):
+            self._image_fetcher = ConcurrentFetcher.from_parameters(
+                load_image,
+                self.parameters
+            )
 
-        return images, processed_urls
+        return self._image_fetcher
 
     @property
     def _net(self):
@@ -121,14 +326,79 @@ class BVLCCaffeNet(PipelineStage):
 
         return self._caffe_net
 
+    @property
+    def _batch_size(self):
+        if not hasattr(self, '_net_batch_size'):
+            batch_size = self.parameters.get('batch_size', 10)
+            if batch_size == 'auto':
+                batch_size = self._tune_batch_size()
+            self._reshape_net(batch_size)
+            self._net_batch_size = batch_size
+
+        return self._net_batch_size
+
+    def _reshape_net(self, batch_size):
+        """
+        Resize the input blob so each forward pass runs on batch_size images
+        """
+        input_blob = self._net.blobs[self._net.inputs[0]]
+        input_blob.reshape(batch_size, *input_blob.data.shape[1:])
+        self._net.reshape()
+
+    def _tune_batch_size(self):
+        """
+        Time the forward pass at each candidate batch size that fits within
+        the memory budget, and return the one with the highest throughput
+        """
+        candidates = sorted(self.parameters.get(
+            'batch_size_candidates',
+            [10, 25, 50, 100, 200]
+        ))
+        memory_budget = self.parameters.get('memory_budget_mb', 2048) * (1 << 20)
+
+        # every blob holds data and a diff of float32 per image
+        bytes_per_image = 2 * 4 * sum(
+            np.prod(blob.data.shape[1:]) for blob in self._net.blobs.values()
+        )
+        fitting = [c for c in candidates if c * bytes_per_image <= memory_budget]
+        if not fitting:
+            logging.warning(
+                "No batch size fits a memory budget of {0}MB, using {1}"
+                .format(memory_budget >> 20, candidates[0])
+            )
+            return candidates[0]
+
+        repeats = self.parameters.get('batch_size_tuning_repeats', 2)
+        best_rate, best_batch_size = 0.0, fitting[0]
+        for batch_size in fitting:
+            self._reshape_net(batch_size)
+            sample = {self._net.inputs[0]: np.zeros(self._input_shape(batch_size), dtype=np.float32)}
+            # the first pass allocates memory for the new shape
+            self._net.forward_all(**sample)
+
+            start = time.time()
+            for repeat in xrange(repeats):
+                self._net.forward_all(**sample)
+            rate = repeats * batch_size / (time.time() - start)
+            logging.info(
+                "Batch size {0}: {1:.1f} images/s".format(batch_size, rate)
+            )
+            if rate > best_rate:
+                best_rate, best_batch_size = rate, batch_size
+
+        logging.info("Using batch size {0}".format(best_batch_size))
+
+        return best_batch_size
+
     def _extract_features(self, inputs, processed_urls, chunk_size):
         logging.debug("Making {0} predictions with {1}".format(chunk_size, self.name))
         layers_to_extract = list(set(self._net.blobs.keys()) & set(self.parameters['output_keys'].keys()))
 
-        out = self._net.forward_all(
-            blobs=layers_to_extract,
-            **{self._net.inputs[0]: inputs}
-        )
+        with span('caffe.forward_all', 'caffe', images=len(processed_urls)):
+            out = self._net.forward_all(
+                blobs=layers_to_extract,
+                **{self._net.inputs[0]: inputs}
+            )
         for key in out.keys():
             if key not in self.parameters['output_keys'].keys():
                 del out[key]
@@ -142,4 +412,50 @@ class BVLCCaffeNet(PipelineStage):
             dtype=self.parameters['output_keys']['processed_urls']['dtype']
         )
 
-        return out
\ No newline at end of file
+        return out
+
+
+def load_image(url, timeout):
+    """
+    Load an image from a local path or any url urllib2 can open, including
+    file:// urls, giving up on the download after timeout seconds
+    """
+    if not is_url(url):
+        return caffe.io.load_image(url)
+
+    extension = os.path.splitext(url.split('?')[0])[1]
+    path = fetch_to_file(url, timeout, suffix=extension)
+    try:
+        return caffe.io.load_image(path)
+    finally:
+        os.remove(path)
+
+
+def _predict_shard(shard):
+    """
+    Runs in a worker process, which builds its own network on first use
+    """
+    stage, input_data, start, stop, shard_filename = shard
+    forget_parent_events()
+    shard = HDF5Interface(shard_filename)
+    # shards are only read once to stitch them, so skip compressing them
+    shard.options = {'compression': 'none'}
+    if stage.checkpoint_key:
+        # shards are numbered, so a shard written for other rows, by a run
+        # with another number of workers, must not be resumed
+        shard.journal = CheckpointJournal.for_output(
+            shard_filename,
+            stage.checkpoint_key,
+            stage.resume,
+            input_rows=(start, stop)
+        )
+    try:
+        with span('caffe.predict_shard', 'caffe', start=start, stop=stop):
+            h5py_file = shard.open_output(stage._output_keys, stop - start, resizable=True)
+            rows = stage._predict_rows(input_data, shard, h5py_file, start, stop)
+            shard.save(h5py_file)
+    finally:
+        stage.close()
+
+    # the parent adds the worker's spans to its trace
+    return rows, take_events()
@@ -1,7 +1,8 @@
+import time
 import logging
 
 import numpy as np
-from sklearn.cross_validation import train_test_split
+from sklearn.cross_validation import ShuffleSplit, StratifiedShuffleSplit
 from sklearn.naive_bayes import MultinomialNB
 
 from brain4k.transforms import PipelineStage
@@ -17,77 +18,161 @@ class NaiveBayes(PipelineStage):
             .format(self.inputs[0].filename, self.name)
         )
         h5py_input = self.inputs[0].io.open(mode='r')
-        data = h5py_input['training_data']
-        target = h5py_input['training_target'].value.flatten()
+        data = self.inputs[0].io.lazy(h5py_input, 'training_data')
+        target = self.inputs[0].io.lazy(h5py_input, 'training_target').read().ravel()
 
         logging.debug("Fitting {0} to data...".format(self.name))
         self.estimator = MultinomialNB()
-        self.estimator.fit(data, target)
+        start = time.time()
+        if self.parameters.get('training_mode', None) == 'incremental':
+            self._partial_fit(data, target)
+        else:
+            self.estimator.fit(data.read(), target)
+        elapsed = time.time() - start
+        logging.info(
+            "Fitted {0} to {1} rows in {2:.2f}s ({3:.0f} rows/s)".format(
+                self.name,
+                len(data),
+                elapsed,
+                len(data) / elapsed if elapsed else 0.0
+            )
+        )
+
+        self.rows_processed += len(data)
 
         self.inputs[0].io.close(h5py_input)
         self.outputs[0].io.save(self.estimator)
 
+    def _partial_fit(self, data, target):
+        """
+        Fit the estimator one block of rows at a time, so the training data
+        never has to fit in memory.  MultinomialNB only sums the features of
+        each class, so this gives the same model as fitting all rows at once.
+        """
+        classes = np.unique(target)
+        max_block_bytes = int(self.parameters.get('memory_budget_mb', 64) * (1 << 20))
+        block_rows = data.block_rows(max_block_bytes)
+        for start, stop, rows in data.iter_blocks(block_rows):
+            self.estimator.partial_fit(rows, target[start:stop], classes=classes)
+            logging.debug("Fitted rows {0} to {1}".format(start, stop))
+
     def test(self):
         logging.debug(
             "Reading testing data and target from {0} for {1}..."
             .format(self.inputs[0].filename, self.name)
         )
         h5py_input = self.inputs[0].io.open(mode='r')
-        data = h5py_input['test_data']
-        target = h5py_input['test_target'].value.flatten()
+        data = self.inputs[0].io.lazy(h5py_input, 'test_data')
+        target = self.inputs[0].io.lazy(h5py_input, 'test_target')
 
         logging.debug("Testing {0}...".format(self.name))
 
         # if the train process has not just been run, the estimator
         # should be loaded as an input
-        predictions = self.estimator.predict(data)
-
-        self.inputs[0].io.close(h5py_input)
-
         h5py_output = self.outputs[1].io.open('w')
-        out = {
-            "predictions": predictions,
-            "actual": target
-        }
         output_keys = {
             'predictions': {
-                'dtype': predictions.dtype.name,
-                'shape': predictions.shape
+                'dtype': self.estimator.classes_.dtype.name,
+                'shape': (len(data),)
             },
             'actual': {
                 'dtype': target.dtype.name,
-                'shape': target.shape
+                'shape': (len(target),)
             }
         }
         self.outputs[1].io.create_dataset(
             h5py_output,
             output_keys
         )
-        self.outputs[1].io.write_chunk(
-            h5py_output,
-            out,
-            output_keys
+
+        # predict a block of rows at a time, writing each block as it goes
+        max_block_bytes = int(self.parameters.get('memory_budget_mb', 64) * (1 << 20))
+        start_time = time.time()
+        for start, stop, rows in data.iter_blocks(data.block_rows(max_block_bytes)):
+            out = {
+                'predictions': self.estimator.predict(rows),
+                'actual': target[start:stop].ravel()
+            }
+            self.outputs[1].io.write_chunk(
+                h5py_output,
+                out,
+                output_keys,
+                start_row=start
+            )
+        elapsed = time.time() - start_time
+        logging.info(
+            "Predicted {0} test rows in {1:.2f}s ({2:.0f} rows/s)".format(
+                len(data),
+                elapsed,
+                len(data) / elapsed if elapsed else 0.0
+            )
         )
 
+        self.rows_processed += len(data)
+
+        self.inputs[0].io.close(h5py_input)
         self.outputs[1].io.save(h5py_output)
 
     def predict(self):
-        features = self.inputs[0].value[self.parameters['data']]
-        self.estimator = self.inputs[1].io.read_all()
-        predicted_labels = self.estimator.predict_proba(features)
+        features = self.inputs[0].value.get(self.parameters['data'], None)
+        if features is None:
+            logging.warning("No features to make predictions for")
+            return []
+
+        # keep the estimator and labels loaded across calls, eg. when serving
+        if not hasattr(self, 'estimator'):
+            self.estimator = self.inputs[1].io.read_all()
+        if not hasattr(self, 'class_names'):
+            label_df = self.inputs[2].io.read_all(index_col=0)
+            label_df.index = label_df.index.astype('uint16')
+            self.class_names = label_df['name'].loc[self.estimator.classes_].values
 
-        label_df = self.inputs[2].io.read_all(index_col=0)
-        label_df.index = label_df.index.astype('uint16')
+        probabilities = self.estimator.predict_proba(features)
+        top_k = min(self.parameters.get('top_k', 1), probabilities.shape[1])
+        top_classes = top_k_columns(probabilities, top_k)
+        top_probabilities = probabilities[
+            np.arange(probabilities.shape[0])[:, np.newaxis],
+            top_classes
+        ]
+        top_names = self.class_names[top_classes]
 
+        predictions = []
         print "CLASSIFIER PREDICTION:"
         print "======================"
-        for index, label in enumerate(predicted_labels):
-            category = np.argmax(predicted_labels)
+        for index, url in enumerate(self.inputs[0].value['processed_urls']):
+            prediction = {
+                'label': top_names[index, 0],
+                'probability': float(top_probabilities[index, 0]),
+                'url': url
+            }
+            if top_k > 1:
+                prediction['top_labels'] = [
+                    {'label': name, 'probability': float(probability)}
+                    for name, probability
+                    in zip(top_names[index], top_probabilities[index])
+                ]
             print "{0} : {1}% : {2}".format(
-                label_df.ix[category]['name'],
-                predicted_labels[0][category] * 100,
-                self.inputs[0].value['processed_urls'][index]
+                prediction['label'],
+                prediction['probability'] * 100,
+                prediction['url']
             )
+            predictions.append(prediction)
+
+        return predictions
+
+
+def top_k_columns(scores, k):
+    """
+    The indexes of the k highest scoring columns of each row, highest first
+    """
+    if k < scores.shape[1]:
+        columns = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        columns = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    rows = np.arange(scores.shape[0])[:, np.newaxis]
+    order = np.argsort(-scores[rows, columns], axis=1, kind='mergesort')
+
+    return columns[rows, order]
 
 
 class TestTrainSplit(PipelineStage):
@@ -95,6 +180,14 @@ class TestTrainSplit(PipelineStage):
     name = "org.scikit-learn.cross_validation.test_train_split"
 
     def split(self):
+        """
+        Split the rows of the data and target datasets into a training and a
+        test set, giving the same split as sklearn's train_test_split for the
+        same random_state.  Only the shuffled row indexes are held in memory:
+        the rows are copied in windows of at most memory_budget_mb, each read
+        in sorted, chunk-aligned runs.  Set stratify to true to keep the
+        proportion of each target class the same in both sets.
+        """
         if len(self.inputs) != 1:
             raise ValueError("{0} expects just one input".format(self.name))
         if len(self.outputs) != 1:
@@ -106,47 +199,105 @@ class TestTrainSplit(PipelineStage):
         )
 
         h5py_input = self.inputs[0].io.open(mode='r')
-        data_key = self.parameters['data']
-        target_key = self.parameters['target']
+        data = h5py_input[self.parameters['data']]
+        target = h5py_input[self.parameters['target']]
+        if data.shape[0] != target.shape[0]:
+            raise ValueError(
+                "{0} expects data and target with the same number of rows, "
+                "got {1} and {2}".format(self.name, data.shape[0], target.shape[0])
+            )
+
+        training_rows, test_rows = self._split_indexes(data.shape[0], target)
 
-        training_features, test_features, training_labels, test_labels = train_test_split(
-            h5py_input[data_key],
-            h5py_input[target_key],
-            test_size=self.parameters['test_size']
-        )
-        data_dtype = h5py_input[data_key].dtype.name
-        target_dtype = h5py_input[target_key].dtype.name
         output_keys = {
             'training_data': {
-                'dtype':  data_dtype,
-                'shape': training_features.shape
+                'dtype':  data.dtype.name,
+                'shape': (training_rows.shape[0],) + data.shape[1:]
             },
             'test_data': {
-                'dtype':  data_dtype,
-                'shape': test_features.shape
+                'dtype':  data.dtype.name,
+                'shape': (test_rows.shape[0],) + data.shape[1:]
             },
             'training_target': {
-                'dtype':  target_dtype,
-                'shape': training_labels.shape
+                'dtype':  target.dtype.name,
+                'shape': (training_rows.shape[0],) + target.shape[1:]
             },
             'test_target': {
-                'dtype':  target_dtype,
-                'shape': test_labels.shape
+                'dtype':  target.dtype.name,
+                'shape': (test_rows.shape[0],) + target.shape[1:]
             }
         }
-        out = {
-            'training_data': training_features,
-            'test_data': test_features,
-            'training_target': training_labels,
-            'test_target': test_labels
-        }
         h5py_output = self.outputs[0].io.open('w')
         self.outputs[0].io.create_dataset(
             h5py_output,
             output_keys
         )
-        self.outputs[0].io.write_chunk(h5py_output, out, output_keys)
+
+        for prefix, rows in (('training', training_rows), ('test', test_rows)):
+            self._copy_rows(
+                h5py_output,
+                output_keys,
+                data,
+                target,
+                rows,
+                prefix
+            )
+            self.rows_processed += rows.shape[0]
 
         self.outputs[0].io.save(h5py_output)
         self.inputs[0].io.close(h5py_input)
 
+    def _split_indexes(self, row_count, target):
+        test_size = self.parameters.get('test_size', None)
+        train_size = self.parameters.get('train_size', None)
+        random_state = self.parameters.get('random_state', None)
+        if test_size is None and train_size is None:
+            # as for train_test_split
+            test_size = 0.25
+
+        if self.parameters.get('stratify', False):
+            # the class of every row is needed to stratify, but not the data
+            cv = StratifiedShuffleSplit(
+                self.inputs[0].io.lazy(target.file, target.name).read().ravel(),
+                test_size=test_size,
+                train_size=train_size,
+                random_state=random_state
+            )
+        else:
+            cv = ShuffleSplit(
+                row_count,
+                test_size=test_size,
+                train_size=train_size,
+                random_state=random_state
+            )
+
+        return next(iter(cv))
+
+    def _copy_rows(self, h5py_output, output_keys, data, target, rows, prefix):
+        """
+        Copy the given rows of data and target, in order, to the
+        <prefix>_data and <prefix>_target datasets
+        """
+        data_key = '{0}_data'.format(prefix)
+        target_key = '{0}_target'.format(prefix)
+        keys = {key: output_keys[key] for key in (data_key, target_key)}
+        io = self.inputs[0].io
+
+        row_bytes = sum(
+            dataset.dtype.itemsize * int(np.prod(dataset.shape[1:]))
+            for dataset in (data, target)
+        )
+        memory_budget = int(self.parameters.get('memory_budget_mb', 512) * (1 << 20))
+        window_rows = max(1, memory_budget / max(row_bytes, 1))
+        chunks = h5py_output[data_key].chunks
+        if chunks and window_rows > chunks[0]:
+            # write whole chunks of the output at a time
+            window_rows -= window_rows % chunks[0]
+
+        for start in xrange(0, rows.shape[0], window_rows):
+            window = rows[start:start + window_rows]
+            out = {
+                data_key: io.read_rows(data, window),
+                target_key: io.read_rows(target, window)
+            }
+            self.outputs[0].io.write_chunk(h5py_output, out, keys, start_row=start)
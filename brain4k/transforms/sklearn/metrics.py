@@ -23,6 +23,11 @@ class ConfusionMatrix(PipelineStage):
         actual_key = input_keys.get('actual', 'actual')
 
         h5py_input = self.inputs[0].io.open(mode='r')
+        # read each once, they are needed whole for the confusion matrix
+        predictions = self.inputs[0].io.lazy(h5py_input, predictions_key).read().ravel()
+        actual = self.inputs[0].io.lazy(h5py_input, actual_key).read().ravel()
+        self.inputs[0].io.close(h5py_input)
+        max_label_known = max(predictions.max(), actual.max())
 
         fig = plt.figure()
         ax = fig.add_subplot(111)
@@ -31,18 +36,14 @@ class ConfusionMatrix(PipelineStage):
         label_names = None
         if len(self.inputs) > 1:
             label_df = self.inputs[1].io.read_all(index_col=0)
-            label_df.index = label_df.index.astype(h5py_input[actual_key].dtype.name)
-            max_label_known = max(
-                h5py_input[predictions_key].value.max(),
-                h5py_input[actual_key].value.max()
-            )
+            label_df.index = label_df.index.astype(actual.dtype.name)
             label_names = list(label_df.name.values[:max_label_known+1])
             ax.set_xticklabels([''] + label_names)
             ax.set_yticklabels([''] + label_names)
 
         confusion = confusion_matrix(
-            h5py_input[actual_key].value,
-            h5py_input[predictions_key].value,
+            actual,
+            predictions,
             range(max_label_known+1)
         )
         cax = ax.matshow(confusion)
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from brain4k.transforms.b4k import DataJoin
+
+
+class DataJoinTests(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.repo_path, 'data'))
+
+        self.ids = np.arange(40)
+        self.features = np.arange(40 * 3, dtype=np.float32).reshape(-1, 3)
+        with h5py.File(os.path.join(self.repo_path, 'data', 'features.h5'), 'w') as f:
+            f['id'] = self.ids.reshape(-1, 1)
+            f['features'] = self.features
+
+        # some ids have no label, and some have several
+        right_ids = [i for i in xrange(39, -1, -1) if i % 5 != 0] + [3, 17, 17, 38]
+        self.right = pd.DataFrame({
+            'id': right_ids,
+            'label': np.arange(len(right_ids)) % 7
+        })
+        self.right.to_csv(os.path.join(self.repo_path, 'data', 'labels.csv'), index=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_path)
+
+    def join(self, **parameters):
+        parameters.update({
+            'left_on': 'id',
+            'right_on': 'id',
+            'retain_keys': {'left': ['features'], 'right': ['label']},
+            'output_keys': {
+                'features': {'dtype': 'float32', 'shape': [0, 3]},
+                'label': {'dtype': 'int64', 'shape': [0, 1]}
+            }
+        })
+        config = {
+            'repo_path': self.repo_path,
+            'data': {
+                'features': {'local_filename': 'features.h5', 'data_type': 'hdf5'},
+                'labels': {'local_filename': 'labels.csv', 'data_type': 'csv'},
+                'joined': {'local_filename': 'joined.h5', 'data_type': 'hdf5'}
+            },
+            'transforms': {
+                'join': {'transform_type': DataJoin.name, 'parameters': parameters}
+            }
+        }
+        stage = DataJoin(
+            {'transform': 'join', 'inputs': ['features', 'labels'], 'outputs': ['joined'], 'actions': ['join']},
+            config,
+            False
+        )
+        stage.chain(['join'])
+
+        with h5py.File(stage.outputs[0].filename, 'r') as f:
+            return f['features'][()], f['label'][()].ravel()
+
+    def expected(self):
+        features = []
+        labels = []
+        for left_row, key in enumerate(self.ids):
+            for label in self.right.label[self.right.id == key]:
+                features.append(self.features[left_row])
+                labels.append(label)
+
+        return np.array(features), np.array(labels)
+
+    def assertJoined(self, joined):
+        features, labels = self.expected()
+        np.testing.assert_array_equal(joined[0], features)
+        np.testing.assert_array_equal(joined[1], labels)
+
+    def test_memory_join_repeats_left_rows_with_several_matches(self):
+        self.assertJoined(self.join(join_mode='memory'))
+
+    def test_streaming_join_repeats_left_rows_with_several_matches(self):
+        # a small budget, so the right side is read in several chunks and
+        # its matches spilled to several partitions
+        self.assertJoined(self.join(join_mode='streaming', memory_budget_mb=0.001))
+
+    def test_join_modes_agree(self):
+        memory = self.join(join_mode='memory')
+        streaming = self.join(join_mode='streaming', memory_budget_mb=0.001)
+
+        for memory_values, streaming_values in zip(memory, streaming):
+            np.testing.assert_array_equal(memory_values, streaming_values)
+
+
+if __name__ == '__main__':
+    unittest.main()
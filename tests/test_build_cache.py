@@ -0,0 +1,173 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+from brain4k.build_cache import BuildCache, unlink_shared_outputs
+from brain4k.data import Data
+from brain4k.pipeline import execute_pipeline
+from brain4k.transforms import PipelineStage
+
+
+class BuildCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.repo_path, 'cache'))
+        self.cache = BuildCache(os.path.join(self.repo_path, 'cache', 'build'))
+        self.config = {
+            'repo_path': self.repo_path,
+            'data': {
+                'model': {'local_filename': 'model.pkl', 'data_type': 'pickle'},
+                'scores': {'local_filename': 'scores.pkl', 'data_type': 'pickle'}
+            }
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_path)
+
+    def outputs(self, *names):
+        return [Data(name, self.config, self.config['data'][name]) for name in names]
+
+    def write(self, datum, contents):
+        # as the pipeline does before running a stage
+        unlink_shared_outputs([datum])
+        with open(datum.filename, 'w') as f:
+            f.write(contents)
+
+    def read(self, datum):
+        with open(datum.filename, 'r') as f:
+            return f.read()
+
+    def test_restores_stored_outputs(self):
+        model, scores = self.outputs('model', 'scores')
+        self.write(model, 'model a')
+        self.write(scores, 'scores a')
+        self.cache.store('a', [model, scores])
+
+        self.write(model, 'model b')
+        os.remove(scores.filename)
+
+        self.assertTrue(self.cache.restore('a', [model, scores]))
+        self.assertEqual(self.read(model), 'model a')
+        self.assertEqual(self.read(scores), 'scores a')
+
+    def test_rewriting_a_restored_output_leaves_the_entry(self):
+        model, = self.outputs('model')
+        self.write(model, 'model a')
+        self.cache.store('a', [model])
+        self.write(model, 'model b')
+
+        self.assertTrue(self.cache.restore('a', [model]))
+        self.assertEqual(self.read(model), 'model a')
+
+    def test_unknown_key_is_not_restored(self):
+        model, = self.outputs('model')
+        self.write(model, 'model b')
+
+        self.assertFalse(self.cache.restore('a', [model]))
+        self.assertEqual(self.read(model), 'model b')
+
+    def test_entry_for_other_outputs_is_not_restored(self):
+        model, scores = self.outputs('model', 'scores')
+        self.write(model, 'model a')
+        self.cache.store('a', [model])
+
+        self.assertFalse(self.cache.restore('a', [model, scores]))
+
+    def test_gc_evicts_least_recently_used_entries(self):
+        model, = self.outputs('model')
+        for key in ('a', 'b', 'c'):
+            self.write(model, key * 100)
+            self.cache.store(key, [model])
+            os.remove(model.filename)
+        self.assertTrue(self.cache.restore('a', [model]))
+
+        self.cache.gc(max_size=250)
+
+        self.assertTrue(self.cache.restore('a', [model]))
+        self.assertFalse(self.cache.restore('b', [model]))
+        self.assertTrue(self.cache.restore('c', [model]))
+
+
+class BuildKeyTests(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.repo_path, 'data'))
+        with h5py.File(os.path.join(self.repo_path, 'data', 'joined.h5'), 'w') as f:
+            f['data'] = np.arange(300).reshape(-1, 3)
+            f['target'] = np.arange(100) % 2
+
+        self.stage = {'transform': 'split', 'inputs': ['joined'], 'outputs': ['split'], 'actions': ['split']}
+        self.config = {
+            'data': {
+                'joined': {'local_filename': 'joined.h5', 'data_type': 'hdf5'},
+                'split': {'local_filename': 'split.h5', 'data_type': 'hdf5'}
+            },
+            'transforms': {
+                'split': {
+                    'transform_type': 'org.scikit-learn.cross_validation.test_train_split',
+                    'parameters': {'data': 'data', 'target': 'target', 'test_size': 0.25, 'random_state': 0}
+                }
+            },
+            'pipelines': {'split': {'stages': [self.stage]}}
+        }
+        self.write_config()
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_path)
+
+    def write_config(self):
+        with open(os.path.join(self.repo_path, 'pipeline.json'), 'w') as f:
+            f.write(json.dumps(self.config))
+
+    def set_parameters(self, **parameters):
+        with open(os.path.join(self.repo_path, 'pipeline.json'), 'r') as f:
+            self.config = json.loads(f.read())
+        self.config['transforms']['split']['parameters'].update(parameters)
+        self.write_config()
+
+    def split_stage(self, **parameters):
+        self.set_parameters(**parameters)
+        config = dict(self.config, repo_path=self.repo_path)
+        return PipelineStage(self.stage, config, False)
+
+    def split_inode(self):
+        return os.stat(os.path.join(self.repo_path, 'cache', 'split.h5')).st_ino
+
+    def test_performance_parameters_are_left_out_of_the_key(self):
+        key = self.split_stage().compute_build_key()
+
+        self.assertEqual(self.split_stage(memory_budget_mb=1).compute_build_key(), key)
+        self.assertNotEqual(self.split_stage(test_size=0.5).compute_build_key(), key)
+
+    def test_checkpoint_key_covers_performance_parameters(self):
+        stage = self.split_stage()
+        key = stage.compute_build_key()
+        checkpoint_key = stage.compute_checkpoint_key(key)
+
+        stage = self.split_stage(memory_budget_mb=1)
+        self.assertEqual(stage.compute_build_key(), key)
+        self.assertNotEqual(stage.compute_checkpoint_key(key), checkpoint_key)
+
+    def test_switching_parameters_back_restores_the_outputs(self):
+        execute_pipeline(self.repo_path, 'split')
+        first_split = self.split_inode()
+
+        self.set_parameters(test_size=0.5)
+        execute_pipeline(self.repo_path, 'split')
+        self.assertNotEqual(self.split_inode(), first_split)
+
+        self.set_parameters(test_size=0.25)
+        execute_pipeline(self.repo_path, 'split')
+        # linked back from the cache entry, rather than written afresh
+        self.assertEqual(self.split_inode(), first_split)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+import pandas as pd
+
+try:
+    from brain4k.transforms.caffe import BVLCCaffeNet
+except ImportError:
+    BVLCCaffeNet = None
+
+
+# rows whose urls can not be fetched, including the whole of some batches
+FAILED_ROWS = set([1, 4, 5, 6, 7, 12, 22])
+
+
+class InjectedFailure(Exception):
+    pass
+
+
+if BVLCCaffeNet is not None:
+
+    class NumberNet(BVLCCaffeNet):
+        """
+        Stands in for the network and the image fetcher: each url is a row
+        number, fetched unless it is one of FAILED_ROWS, and its features
+        are twice that number
+        """
+
+        @property
+        def _net(self):
+            return None
+
+        def _reshape_net(self, batch_size):
+            pass
+
+        def _input_shape(self, batch_size):
+            return (batch_size, 1)
+
+        def _fetch_images(self, urls):
+            urls = list(urls)
+            positions = [
+                position for position, url in enumerate(urls)
+                if int(url) not in FAILED_ROWS
+            ]
+            images = [int(urls[position]) for position in positions]
+            return images, [urls[position] for position in positions], positions
+
+        def _preprocess_images(self, images, chunk_size):
+            inputs = self._input_buffers.acquire()
+            inputs[:len(images), 0] = images
+            inputs[len(images):] = 0
+            return inputs
+
+        def _extract_features(self, inputs, processed_urls, chunk_size):
+            self.extracted.extend(int(url) for url in processed_urls)
+            return {
+                'fc7': inputs[:len(processed_urls)] * 2,
+                'processed_urls': np.array(processed_urls, dtype='S16')
+            }
+
+
+@unittest.skipIf(BVLCCaffeNet is None, "caffe is not installed")
+class DensePackingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.repo_path, 'data'))
+        self.row_count = 23
+        pd.DataFrame({
+            'url': [str(row) for row in xrange(self.row_count)]
+        }).to_csv(os.path.join(self.repo_path, 'data', 'urls.csv'), index=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_path)
+
+    def predict(self, resume=False, fail_after_writes=None, **parameters):
+        """
+        Extract features for the urls, returning the output and the rows
+        whose features were extracted in this process, after failing once
+        fail_after_writes batches have been written if given
+        """
+        parameters.update({
+            'output_keys': {
+                'fc7': {'dtype': 'float32', 'shape': [0, 1]},
+                'processed_urls': {'dtype': 'S16', 'shape': [0]}
+            }
+        })
+        config = {
+            'repo_path': self.repo_path,
+            'data': {
+                'urls': {'local_filename': 'urls.csv', 'data_type': 'csv'},
+                'features': {'local_filename': 'features.h5', 'data_type': 'hdf5'}
+            },
+            'transforms': {
+                'caffe': {'transform_type': NumberNet.name, 'parameters': parameters}
+            }
+        }
+        stage = NumberNet(
+            {'transform': 'caffe', 'inputs': ['urls'], 'outputs': ['features'], 'actions': ['predict']},
+            config,
+            False
+        )
+        stage.checkpoint_key = 'key'
+        stage.resume = resume
+        stage.extracted = []
+
+        if fail_after_writes is not None:
+            io = stage.outputs[0].io
+            write_chunk = io.write_chunk
+            writes = []
+
+            def failing_write_chunk(*args, **kwargs):
+                if len(writes) == fail_after_writes:
+                    raise InjectedFailure()
+                write_chunk(*args, **kwargs)
+                writes.append(None)
+
+            io.write_chunk = failing_write_chunk
+        stage.chain(['predict'])
+
+        with h5py.File(stage.outputs[0].filename, 'r') as f:
+            return {key: f[key][()] for key in f.keys()}, stage.extracted
+
+    def assertPacked(self, output):
+        fetched_rows = [row for row in xrange(self.row_count) if row not in FAILED_ROWS]
+
+        self.assertEqual(output['input_rows'].tolist(), fetched_rows)
+        self.assertEqual(output['fc7'].ravel().tolist(), [2 * row for row in fetched_rows])
+        self.assertEqual(output['processed_urls'].tolist(), [str(row) for row in fetched_rows])
+
+    def test_rows_that_could_not_be_fetched_are_left_out(self):
+        output, extracted = self.predict(batch_size=2)
+
+        self.assertPacked(output)
+
+    def test_outputs_are_trimmed_to_the_rows_written(self):
+        output, extracted = self.predict(batch_size=5)
+
+        for values in output.values():
+            self.assertEqual(values.shape[0], self.row_count - len(FAILED_ROWS))
+
+    def test_shards_are_stitched_end_to_end(self):
+        output, extracted = self.predict(batch_size=2, workers=3)
+
+        self.assertPacked(output)
+
+    def test_failed_extraction_is_resumed(self):
+        with self.assertRaises(InjectedFailure):
+            self.predict(batch_size=3, fail_after_writes=2)
+
+        output, extracted = self.predict(batch_size=3, resume=True)
+
+        self.assertPacked(output)
+        # the two batches written, rows 0 to 5, are not extracted again
+        self.assertEqual(extracted, [row for row in xrange(6, self.row_count) if row not in FAILED_ROWS])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from brain4k.checkpoint import CheckpointJournal
+from brain4k.transforms.b4k import DataJoin
+
+
+class CheckpointJournalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.output_filename = os.path.join(self.directory, 'out.h5')
+        with open(self.output_filename, 'w') as f:
+            f.write('rows')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def journal(self, key='key', resume=True, input_rows=None):
+        return CheckpointJournal.for_output(self.output_filename, key, resume, input_rows)
+
+    def test_committed_ranges(self):
+        journal = self.journal(resume=False)
+        journal.commit(0, 10, ['a', 'b'])
+        journal.commit(10, 20, ['a'])
+        journal.commit(30, 40, ['a', 'b'])
+
+        self.assertTrue(journal.is_committed(5, 20, ['a']))
+        self.assertFalse(journal.is_committed(5, 20, ['a', 'b']))
+        self.assertFalse(journal.is_committed(15, 35, ['a']))
+        self.assertEqual(journal.committed_stop(['a']), 20)
+        self.assertEqual(journal.committed_stop(['a', 'b']), 10)
+
+    def test_resumed_with_the_same_key(self):
+        self.journal(resume=False).commit(0, 10, ['a'])
+
+        journal = self.journal()
+
+        self.assertTrue(journal.resumed)
+        self.assertTrue(journal.is_committed(0, 10, ['a']))
+
+    def test_not_resumed_unless_asked(self):
+        self.journal(resume=False).commit(0, 10, ['a'])
+
+        journal = self.journal(resume=False)
+
+        self.assertFalse(journal.resumed)
+        self.assertFalse(journal.is_committed(0, 10, ['a']))
+
+    def test_not_resumed_with_another_key(self):
+        self.journal(resume=False).commit(0, 10, ['a'])
+
+        self.assertFalse(self.journal(key='other').resumed)
+
+    def test_not_resumed_for_other_input_rows(self):
+        self.journal(resume=False, input_rows=(0, 10)).commit(0, 10, ['a'])
+
+        self.assertFalse(self.journal(input_rows=(0, 15)).resumed)
+        self.assertFalse(self.journal(input_rows=None).resumed)
+
+    def test_not_resumed_without_its_output(self):
+        self.journal(resume=False).commit(0, 10, ['a'])
+        os.remove(self.output_filename)
+
+        self.assertFalse(self.journal().resumed)
+
+    def test_line_cut_short_by_a_crash_is_ignored(self):
+        journal = self.journal(resume=False)
+        journal.commit(0, 10, ['a'])
+        with open(journal.filename, 'a') as f:
+            f.write('[10, 2')
+
+        journal = self.journal()
+
+        self.assertEqual(journal.committed_stop(['a']), 10)
+
+
+class InjectedFailure(Exception):
+    pass
+
+
+class ResumeJoinTests(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.repo_path, 'data'))
+        with h5py.File(os.path.join(self.repo_path, 'data', 'features.h5'), 'w') as f:
+            f['id'] = np.arange(200).reshape(-1, 1)
+            f['features'] = np.arange(200 * 3, dtype=np.float32).reshape(-1, 3)
+        pd.DataFrame({
+            'id': np.arange(199, -1, -1),
+            'label': np.arange(200) % 7
+        }).to_csv(os.path.join(self.repo_path, 'data', 'labels.csv'), index=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_path)
+
+    def join_stage(self, resume=False):
+        config = {
+            'repo_path': self.repo_path,
+            'data': {
+                'features': {'local_filename': 'features.h5', 'data_type': 'hdf5'},
+                'labels': {'local_filename': 'labels.csv', 'data_type': 'csv'},
+                'joined': {'local_filename': 'joined.h5', 'data_type': 'hdf5'}
+            },
+            'transforms': {
+                'join': {
+                    'transform_type': DataJoin.name,
+                    'parameters': {
+                        'join_mode': 'streaming',
+                        # small enough to write the output in several partitions
+                        'memory_budget_mb': 0.002,
+                        'left_on': 'id',
+                        'right_on': 'id',
+                        'retain_keys': {'left': ['features'], 'right': ['label']},
+                        'output_keys': {
+                            'features': {'dtype': 'float32', 'shape': [0, 3]},
+                            'label': {'dtype': 'int64', 'shape': [0, 1]}
+                        }
+                    }
+                }
+            }
+        }
+        stage = DataJoin(
+            {'transform': 'join', 'inputs': ['features', 'labels'], 'outputs': ['joined'], 'actions': ['join']},
+            config,
+            False
+        )
+        stage.checkpoint_key = 'key'
+        stage.resume = resume
+        return stage
+
+    def count_writes(self, stage, fail_after=None):
+        """
+        Count the chunks stage writes to its output, failing once
+        fail_after have been written
+        """
+        io = stage.outputs[0].io
+        write_chunk = io.write_chunk
+        writes = []
+
+        def counted_write_chunk(*args, **kwargs):
+            if fail_after is not None and len(writes) == fail_after:
+                raise InjectedFailure()
+            write_chunk(*args, **kwargs)
+            writes.append(kwargs.get('start_row', args[-1]))
+
+        io.write_chunk = counted_write_chunk
+        return writes
+
+    def read(self, stage):
+        with h5py.File(stage.outputs[0].filename, 'r') as f:
+            return f['features'][()], f['label'][()]
+
+    def test_failed_join_is_resumed_from_its_last_chunk(self):
+        stage = self.join_stage()
+        writes = self.count_writes(stage)
+        stage.chain(['join'])
+        expected = self.read(stage)
+        self.assertGreater(len(writes), 3)
+
+        stage = self.join_stage()
+        self.count_writes(stage, fail_after=2)
+        with self.assertRaises(InjectedFailure):
+            stage.chain(['join'])
+        # the rows written are kept for the resumed run
+        self.assertTrue(os.path.exists(stage.outputs[0].filename + '.journal'))
+
+        stage = self.join_stage(resume=True)
+        resumed_writes = self.count_writes(stage)
+        stage.chain(['join'])
+
+        self.assertEqual(resumed_writes, writes[2:])
+        for values, expected_values in zip(self.read(stage), expected):
+            np.testing.assert_array_equal(values, expected_values)
+        self.assertFalse(os.path.exists(stage.outputs[0].filename + '.journal'))
+
+    def test_failed_join_starts_over_without_resume(self):
+        stage = self.join_stage()
+        writes = self.count_writes(stage, fail_after=2)
+        with self.assertRaises(InjectedFailure):
+            stage.chain(['join'])
+
+        stage = self.join_stage()
+        restarted_writes = self.count_writes(stage)
+        stage.chain(['join'])
+
+        self.assertEqual(restarted_writes[:2], writes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+from brain4k.brain4k import run
+from brain4k.transforms import PipelineStage, TRANSFORMS
+
+
+class RecordUrls(PipelineStage):
+    """
+    Stands in for a feature extractor, recording the urls it was given
+    """
+
+    name = 'test.record_urls'
+    calls = []
+
+    def predict_for_url(self):
+        RecordUrls.calls.append(self.inputs[0].value)
+        return [[]]
+
+
+class PredictCommandTests(unittest.TestCase):
+
+    def setUp(self):
+        TRANSFORMS[RecordUrls.name] = '{0}.RecordUrls'.format(__name__)
+        RecordUrls.calls = []
+
+        self.repo_path = tempfile.mkdtemp()
+        config = {
+            'data': {
+                'url': {'data_type': 'argument'},
+                'predictions': {'data_type': 'argument'}
+            },
+            'transforms': {
+                'record': {'transform_type': RecordUrls.name}
+            },
+            'pipelines': {
+                'predict': {
+                    'ephemeral': True,
+                    'stages': [{
+                        'transform': 'record',
+                        'inputs': ['url'],
+                        'outputs': ['predictions'],
+                        'actions': ['predict_for_url']
+                    }]
+                }
+            }
+        }
+        with open(os.path.join(self.repo_path, 'pipeline.json'), 'w') as f:
+            f.write(json.dumps(config))
+
+    def tearDown(self):
+        del TRANSFORMS[RecordUrls.name]
+        shutil.rmtree(self.repo_path)
+
+    def brain4k(self, *args):
+        argv = sys.argv
+        sys.argv = ['brain4k'] + list(args)
+        try:
+            run()
+        finally:
+            sys.argv = argv
+
+    def test_several_urls_are_predicted_in_one_run(self):
+        self.brain4k(self.repo_path, '-p', 'predict', 'http://a/1.jpg', 'http://b/2.jpg')
+
+        self.assertEqual(RecordUrls.calls, [['http://a/1.jpg', 'http://b/2.jpg']])
+
+    def test_a_single_url_is_passed_as_is(self):
+        self.brain4k(self.repo_path, '-p', 'predict', 'http://a/1.jpg')
+
+        self.assertEqual(RecordUrls.calls, ['http://a/1.jpg'])
+
+
+if __name__ == '__main__':
+    unittest.main()
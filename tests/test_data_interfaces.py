@@ -0,0 +1,190 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+from brain4k.checkpoint import CheckpointJournal
+from brain4k.data import Data
+from brain4k.data_interfaces import HDF5Interface, plan_row_reads
+
+
+class CSVRowIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.repo_path, 'data'))
+        with open(os.path.join(self.repo_path, 'data', 'urls.csv'), 'w') as f:
+            f.write('url,label\n')
+            for row in xrange(10):
+                f.write('http://a/{0}.jpg,{1}\n'.format(row, row % 2))
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_path)
+
+    def csv(self):
+        config = {'repo_path': self.repo_path}
+        return Data('urls', config, {'local_filename': 'urls.csv', 'data_type': 'csv'})
+
+    def test_index_is_kept_in_the_cache(self):
+        self.assertEqual(self.csv().io.get_row_count(), 10)
+
+        self.assertEqual(os.listdir(os.path.join(self.repo_path, 'data')), ['urls.csv'])
+        index_filename = self.csv().io.row_index.index_filename
+        self.assertEqual(
+            os.path.dirname(index_filename),
+            os.path.join(self.repo_path, 'cache', 'row_index')
+        )
+        self.assertTrue(os.path.exists(index_filename))
+
+    def test_rows_are_read_from_the_stored_index(self):
+        self.csv().io.get_row_count()
+
+        chunks = list(self.csv().io.read_chunk(4, keys=['url'], start=3, stop=9))
+        urls = [url for chunk in chunks for url in chunk['url']]
+        self.assertEqual(urls, ['http://a/{0}.jpg'.format(row) for row in xrange(3, 9)])
+
+
+class ReadRowsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.io = HDF5Interface(os.path.join(self.directory, 'rows.h5'))
+        self.values = np.arange(1000 * 4, dtype=np.float32).reshape(-1, 4)
+        self.h5py_file = h5py.File(self.io.filename, 'w')
+        self.h5py_file.create_dataset('chunked', data=self.values, chunks=(64, 4), compression='gzip')
+        self.h5py_file.create_dataset('contiguous', data=self.values)
+
+    def tearDown(self):
+        self.h5py_file.close()
+        shutil.rmtree(self.directory)
+
+    def test_rows_are_returned_in_the_order_given(self):
+        rows = np.random.RandomState(0).randint(0, 1000, 300)
+        rows[:3] = [999, 0, 999]
+
+        for key in ('chunked', 'contiguous'):
+            np.testing.assert_array_equal(
+                self.io.read_rows(self.h5py_file[key], rows),
+                self.values[rows]
+            )
+
+    def test_runs_are_capped_in_size(self):
+        rows = np.arange(0, 1000, 3)
+
+        np.testing.assert_array_equal(
+            self.io.read_rows(self.h5py_file['chunked'], rows, max_run_bytes=64 * 4 * 4 * 2),
+            self.values[rows]
+        )
+
+    def test_no_rows(self):
+        rows = self.io.read_rows(self.h5py_file['chunked'], [])
+
+        self.assertEqual(rows.shape, (0, 4))
+
+
+class ResizableOutputTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.io = HDF5Interface(os.path.join(self.directory, 'out.h5'))
+        self.output_keys = {
+            'features': {'dtype': 'float32', 'shape': [0, 3]},
+            'input_rows': {'dtype': 'int64', 'shape': [0]}
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, h5py_file, input_rows, start_row):
+        input_rows = np.array(input_rows)
+        self.io.write_chunk(
+            h5py_file,
+            {
+                'features': np.repeat(input_rows, 3).astype(np.float32).reshape(-1, 3),
+                'input_rows': input_rows
+            },
+            self.output_keys,
+            start_row
+        )
+        return start_row + input_rows.shape[0]
+
+    def read(self):
+        with h5py.File(self.io.filename, 'r') as f:
+            return f['features'][()], f['input_rows'][()]
+
+    def test_rows_written_one_after_another_are_trimmed_to_size(self):
+        h5py_file = self.io.open_output(self.output_keys, 10, resizable=True)
+        cursor = self.write(h5py_file, [0, 2], 0)
+        cursor = self.write(h5py_file, [5, 6, 7], cursor)
+        self.io.trim(h5py_file, self.output_keys.keys(), cursor)
+        self.io.save(h5py_file)
+
+        features, input_rows = self.read()
+        self.assertEqual(input_rows.tolist(), [0, 2, 5, 6, 7])
+        np.testing.assert_array_equal(features[:, 0], input_rows)
+
+    def test_rows_can_be_trimmed_away(self):
+        h5py_file = self.io.open_output(self.output_keys, 10, resizable=True)
+        self.io.trim(h5py_file, self.output_keys.keys(), 0)
+        self.io.save(h5py_file)
+
+        features, input_rows = self.read()
+        self.assertEqual(features.shape, (0, 3))
+        self.assertEqual(input_rows.shape, (0,))
+
+    def test_resumed_file_carries_on_after_its_committed_rows(self):
+        self.io.journal = CheckpointJournal.for_output(self.io.filename, 'key')
+        h5py_file = self.io.open_output(self.output_keys, 10, resizable=True)
+        cursor = self.write(h5py_file, [0, 2], 0)
+        self.write(h5py_file, [5, 6, 7], cursor)
+        h5py_file.close()
+
+        self.io.journal = CheckpointJournal.for_output(self.io.filename, 'key', resume=True)
+        self.assertEqual(self.io.committed_rows(self.output_keys.keys()), 5)
+        h5py_file = self.io.open_output(self.output_keys, 10, resizable=True)
+        cursor = self.write(h5py_file, [9], 5)
+        self.io.trim(h5py_file, self.output_keys.keys(), cursor)
+        self.io.save(h5py_file)
+
+        self.assertEqual(self.read()[1].tolist(), [0, 2, 5, 6, 7, 9])
+
+
+class PlanRowReadsTests(unittest.TestCase):
+
+    def plan(self, rows, block_rows=10, max_run_blocks=3, row_count=100):
+        return list(plan_row_reads(np.array(rows), block_rows, max_run_blocks, row_count))
+
+    def test_runs_cover_whole_blocks(self):
+        self.assertEqual(self.plan([12, 15]), [(10, 20, 0, 2)])
+
+    def test_rows_in_neighbouring_blocks_share_a_run(self):
+        self.assertEqual(self.plan([5, 15, 25]), [(0, 30, 0, 3)])
+
+    def test_gaps_between_blocks_split_runs(self):
+        self.assertEqual(self.plan([5, 35, 36]), [(0, 10, 0, 1), (30, 40, 1, 3)])
+
+    def test_long_runs_are_split(self):
+        self.assertEqual(
+            self.plan(range(0, 70, 5)),
+            [(0, 30, 0, 6), (30, 60, 6, 12), (60, 70, 12, 14)]
+        )
+
+    def test_last_run_stops_at_the_end_of_the_dataset(self):
+        self.assertEqual(self.plan([93, 95], row_count=96), [(90, 96, 0, 2)])
+
+    def test_every_row_is_in_its_run(self):
+        rows = np.unique(np.random.RandomState(1).randint(0, 1000, 200))
+        covered = 0
+        for start, stop, first, last in plan_row_reads(rows, 16, 4, 1000):
+            self.assertEqual(first, covered)
+            self.assertTrue(np.all((rows[first:last] >= start) & (rows[first:last] < stop)))
+            self.assertLessEqual(stop - start, 16 * 4)
+            covered = last
+        self.assertEqual(covered, rows.shape[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+import os
+import re
+import shutil
+import urllib
+import hashlib
+import tempfile
+import threading
+import unittest
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from brain4k.fetch import ConcurrentFetcher, fetch_to_file, download_file
+
+
+def read_url(url, timeout):
+    path = fetch_to_file(url, timeout)
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+
+class ConcurrentFetcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.urls = []
+        for index in xrange(20):
+            path = os.path.join(self.directory, '{0}.txt'.format(index))
+            # every fifth file is missing, so fetching it fails
+            if index % 5 != 3:
+                with open(path, 'wb') as f:
+                    f.write('image {0}'.format(index))
+            self.urls.append('file://' + urllib.pathname2url(path))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fetch(self, urls, **kwargs):
+        fetcher = ConcurrentFetcher(read_url, retry_backoff=0, **kwargs)
+        try:
+            return fetcher.fetch(urls)
+        finally:
+            fetcher.close()
+
+    def test_results_keep_the_order_of_the_urls(self):
+        results = self.fetch(self.urls, workers=4)
+
+        for index, result in enumerate(results):
+            if index % 5 == 3:
+                self.assertIsNone(result)
+            else:
+                self.assertEqual(result, 'image {0}'.format(index))
+
+    def test_failed_urls_are_the_only_ones_dropped(self):
+        results = self.fetch(self.urls, workers=4, retries=1)
+
+        fetched = [index for index, result in enumerate(results) if result is not None]
+        self.assertEqual(fetched, [index for index in xrange(20) if index % 5 != 3])
+
+    def test_one_worker_fetches_the_same(self):
+        self.assertEqual(
+            self.fetch(self.urls, workers=1),
+            self.fetch(self.urls, workers=8)
+        )
+
+    def test_failures_are_retried(self):
+        attempts = []
+
+        def flaky(url, timeout):
+            attempts.append(url)
+            if attempts.count(url) < 3:
+                raise IOError("connection reset")
+            return read_url(url, timeout)
+
+        fetcher = ConcurrentFetcher(flaky, workers=4, retries=2, retry_backoff=0)
+        try:
+            results = fetcher.fetch(self.urls[:2])
+        finally:
+            fetcher.close()
+
+        self.assertEqual(results, ['image 0', 'image 1'])
+        self.assertEqual(len(attempts), 6)
+
+    def test_close_stops_the_workers(self):
+        fetcher = ConcurrentFetcher(read_url, workers=4, retry_backoff=0)
+        fetcher.fetch(self.urls)
+        pool = fetcher._pool
+        fetcher.close()
+
+        self.assertIsNone(fetcher._pool)
+        self.assertFalse(any(worker.is_alive() for worker in pool._pool))
+
+
+class BlobHandler(BaseHTTPRequestHandler):
+    """
+    Serves the server's body, honouring Range requests if it supports them,
+    and dropping the connection after cut_after bytes of the first response
+    """
+
+    def do_GET(self):
+        server = self.server
+        server.ranges.append(self.headers.getheader('Range'))
+        body = server.body
+        start = 0
+        match = re.match(r'bytes=(\d+)-$', self.headers.getheader('Range') or '')
+        if match and server.supports_range:
+            start = int(match.group(1))
+            self.send_response(206)
+            self.send_header(
+                'Content-Range',
+                'bytes {0}-{1}/{2}'.format(start, len(body) - 1, len(body))
+            )
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+
+        if server.cut_after is not None:
+            cut_after, server.cut_after = server.cut_after, None
+            self.wfile.write(body[start:start + cut_after])
+            return
+        self.wfile.write(body[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadFileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'blob.bin')
+
+        self.server = HTTPServer(('127.0.0.1', 0), BlobHandler)
+        self.server.body = os.urandom(3 << 20)
+        self.server.sha1 = hashlib.sha1(self.server.body).hexdigest()
+        self.server.cut_after = None
+        self.server.supports_range = True
+        self.server.ranges = []
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{0}/blob.bin'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def download(self, sha1=None):
+        download_file(self.url, self.filename, sha1 or self.server.sha1, timeout=5, retry_backoff=0)
+
+    def assertDownloaded(self):
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(hashlib.sha1(f.read()).hexdigest(), self.server.sha1)
+        self.assertFalse(os.path.exists(self.filename + '.part'))
+
+    def test_cut_off_download_is_resumed_with_a_range_request(self):
+        self.server.cut_after = 1 << 20
+
+        self.download()
+
+        self.assertDownloaded()
+        self.assertEqual(self.server.ranges, [None, 'bytes={0}-'.format(1 << 20)])
+
+    def test_download_starts_over_if_the_server_ignores_ranges(self):
+        self.server.cut_after = 1 << 20
+        self.server.supports_range = False
+
+        self.download()
+
+        self.assertDownloaded()
+        self.assertEqual(len(self.server.ranges), 2)
+
+    def test_part_file_left_by_an_earlier_run_is_carried_on_from(self):
+        with open(self.filename + '.part', 'wb') as f:
+            f.write(self.server.body[:12345])
+
+        self.download()
+
+        self.assertDownloaded()
+        self.assertEqual(self.server.ranges, ['bytes=12345-'])
+
+    def test_mismatched_hash_leaves_no_file(self):
+        self.server.cut_after = 1 << 20
+
+        with self.assertRaises(Exception):
+            self.download(sha1='0' * 40)
+
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertFalse(os.path.exists(self.filename + '.part'))
+
+
+if __name__ == '__main__':
+    unittest.main()
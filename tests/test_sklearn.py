@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+# imported by module, so test runners do not mistake the transform for tests
+from brain4k.transforms import sklearn as sklearn_transforms
+
+
+class TestTrainSplitTests(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.repo_path, 'data'))
+        self.target = np.repeat([0, 1, 2, 3], [40, 40, 10, 10])
+        with h5py.File(os.path.join(self.repo_path, 'data', 'joined.h5'), 'w') as f:
+            f['data'] = np.arange(self.target.shape[0] * 3).reshape(-1, 3)
+            f['target'] = self.target
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_path)
+
+    def split(self, checkpoint_key=None, **parameters):
+        config = {
+            'repo_path': self.repo_path,
+            'data': {
+                'joined': {'local_filename': 'joined.h5', 'data_type': 'hdf5'},
+                'split': {'local_filename': 'split.h5', 'data_type': 'hdf5'}
+            },
+            'transforms': {
+                'split': {
+                    'transform_type': sklearn_transforms.TestTrainSplit.name,
+                    'parameters': dict(parameters, data='data', target='target')
+                }
+            }
+        }
+        stage = sklearn_transforms.TestTrainSplit(
+            {'transform': 'split', 'inputs': ['joined'], 'outputs': ['split'], 'actions': ['split']},
+            config,
+            False
+        )
+        stage.checkpoint_key = checkpoint_key
+        stage.chain(['split'])
+        self.output_io = stage.outputs[0].io
+
+        with h5py.File(stage.outputs[0].filename, 'r') as f:
+            return {key: f[key][()] for key in f.keys()}
+
+    def test_stratified_split_defaults_to_a_quarter_for_test(self):
+        split = self.split(stratify=True, random_state=0)
+
+        self.assertEqual(split['test_target'].shape[0], 25)
+        self.assertEqual(split['training_target'].shape[0], 75)
+        # every class is split in the same proportion, give or take rounding
+        expected = np.bincount(self.target) * 0.25
+        for count, share in zip(np.bincount(split['test_target']), expected):
+            self.assertLessEqual(abs(count - share), 1)
+
+    def test_rows_keep_their_targets(self):
+        split = self.split(stratify=True, random_state=0)
+
+        for prefix in ('training', 'test'):
+            rows = split['{0}_data'.format(prefix)][:, 0] // 3
+            self.assertEqual(
+                self.target[rows].tolist(),
+                split['{0}_target'.format(prefix)].tolist()
+            )
+
+    def test_split_output_is_not_journaled(self):
+        # the split rewrites its output from the start, so cannot resume it
+        self.split(checkpoint_key='key', stratify=True, random_state=0)
+
+        self.assertIsNone(self.output_io.journal)
+
+
+if __name__ == '__main__':
+    unittest.main()